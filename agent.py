@@ -1,22 +1,140 @@
 import asyncio
-from typing import List, Union
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
+import logging
+import os
+from typing import AsyncIterator, List, NamedTuple, Union
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, ToolMessage, SystemMessage, RemoveMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
 from langchain_core.tools import tool, BaseTool
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import Runnable
 from langgraph.prebuilt import create_react_agent
-from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain_openai import ChatOpenAI 
 from langchain_core.prompts import MessagesPlaceholder
 from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from answer_cache import get_answer_cache
+from mcp_session import MCPSession
+from metrics import configure_logging
+from text_utils import SentenceBuffer
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 LLM_API_KEY = os.getenv('LLM_API_KEY')
 LLM_PROMPT = os.getenv('LLM_PROMPT')
-MCP_URL = os.getenv('MCP_URL')
+# Optional OpenAI-compatible endpoint (e.g. a proxy or the local stand-ins of benchmark.py)
+LLM_BASE_URL = os.getenv('LLM_BASE_URL') or None
+# Bounded conversation memory: maximum number of tokens of history sent to the LLM. 0 means unbounded
+AGENT_HISTORY_TOKENS = int(os.getenv('AGENT_HISTORY_TOKENS', '0'))
+# Number of recent user turns whose tool results are kept complete
+AGENT_TOOL_RESULTS_TURNS = int(os.getenv('AGENT_TOOL_RESULTS_TURNS', '1'))
+# Summarize the older turns instead of dropping them
+AGENT_SUMMARIZE = os.getenv('AGENT_SUMMARIZE', 'false').lower() in ('1', 'true', 'yes')
+
+SUMMARY_PROMPT = ("Resume brevemente la siguiente conversación entre un usuario y un asistente, "
+                  "conservando los datos relevantes para continuarla. Contesta solo con el resumen.")
+OMITTED_TOOL_RESULT = "[resultado omitido]"
+INTERRUPTED_TOOL_RESULT = "[interrumpido por el usuario]"
+
+class AgentEvent(NamedTuple):
+    """
+    Event produced while the agent answer is streamed (see MCPAgent.astream).
+    - type: SENTENCE (a complete sentence of the answer), TOOL_CALL (the agent starts
+      a tool call), TOOL_RESULT (a tool call is finished) or ERROR (no answer could be
+      generated; the sentences that follow are the error message).
+    - content: the sentence, the tool name or the error.
+    """
+    type: str
+    content: str
+
+    SENTENCE = "sentence"
+    TOOL_CALL = "tool_call"
+    TOOL_RESULT = "tool_result"
+    ERROR = "error"
+
+
+class HistoryLimiter:
+    """
+    Bounded conversation memory, used as the pre-model hook of the agent.
+
+    Before each LLM call the history of the thread is reduced:
+    - The results of the tool calls older than the last `tool_results_turns` user turns
+      are replaced by a short placeholder.
+    - If the history still exceeds `max_tokens`, the oldest turns are dropped or,
+      when `summarize` is enabled, folded into a rolling summary. The current turn
+      (the last user message and what follows it) is always kept complete.
+
+    The reduced history replaces the one stored in the checkpointer, so the memory
+    used by each thread stays bounded too.
+    """
+
+    def __init__(self, llm, max_tokens: int = AGENT_HISTORY_TOKENS,
+                 tool_results_turns: int = AGENT_TOOL_RESULTS_TURNS, summarize: bool = AGENT_SUMMARIZE):
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.tool_results_turns = tool_results_turns
+        self.summarize = summarize
+
+    def _compact_tool_results(self, messages: List[BaseMessage]) -> tuple[List[BaseMessage], bool]:
+        human_positions = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        if len(human_positions) <= self.tool_results_turns:
+            return messages, False
+
+        limit = human_positions[-self.tool_results_turns] if self.tool_results_turns > 0 else len(messages)
+        changed = False
+        compacted = []
+        for i, message in enumerate(messages):
+            if i < limit and isinstance(message, ToolMessage) and message.content != OMITTED_TOOL_RESULT:
+                message = message.model_copy(update={"content": OMITTED_TOOL_RESULT})
+                changed = True
+            compacted.append(message)
+        return compacted, changed
+
+    async def _summarize(self, older: List[BaseMessage]) -> SystemMessage:
+        transcript = "\n".join(f"{message.type}: {message.text()}" for message in older
+                               if not isinstance(message, ToolMessage) and message.text())
+        response = await self.llm.ainvoke([SystemMessage(SUMMARY_PROMPT), HumanMessage(transcript)])
+        return SystemMessage(f"Resumen de la conversación anterior: {response.text()}")
+
+    async def __call__(self, state) -> dict:
+        messages, changed = self._compact_tool_results(state["messages"])
+
+        if count_tokens_approximately(messages) > self.max_tokens:
+            # The current turn (from the last user message) is always kept; only the older turns are reduced
+            start = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=0)
+            history, current = messages[:start], messages[start:]
+            summary = [history.pop(0)] if history and isinstance(history[0], SystemMessage) else []
+
+            budget = self.max_tokens - count_tokens_approximately(summary + current)
+            if budget < 0:
+                logger.warning(f"The current turn exceeds the conversation budget ({self.max_tokens} tokens)")
+            # Keep the most recent turns that fit in the budget (always starting on a user message)
+            kept = trim_messages(history, max_tokens=budget, strategy="last",
+                                 token_counter=count_tokens_approximately,
+                                 start_on="human") if budget > 0 and history else []
+            older = history[:len(history) - len(kept)]
+
+            if older:
+                if self.summarize:
+                    try:
+                        # The previous summary is folded into the new one
+                        summary = [await self._summarize(summary + older)]
+                    except Exception as e:
+                        logger.warning(f"Error summarizing the conversation: {e}")
+
+                messages = summary + kept + current
+                changed = True
+                logger.info(f"Conversation history reduced to {len(messages)} messages")
+
+        if not changed:
+            return {"llm_input_messages": messages}
+
+        return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *messages]}
+
 
 class MCPAgent:
     """
@@ -27,41 +145,134 @@ class MCPAgent:
 
     def __init__(self):
         self.checkpointer = InMemorySaver()
+        self.mcp = MCPSession()
 
     async def _ainitialize(self, role: str):
+        self.role = role
         self.tools = await self._load_mcp_tools() 
-        print(self.tools)
+        logger.debug(self.tools)
 
-        self.llm = ChatOpenAI(model="gpt-4o", api_key=LLM_API_KEY, temperature=0)
+        self.llm = ChatOpenAI(model="gpt-4o", api_key=LLM_API_KEY, base_url=LLM_BASE_URL, temperature=0)
 
+        self._build_executor()
+        logger.info("Agent created")
+
+        # Keep the tool catalogue updated in background
+        self.mcp.on_tools_changed = self._on_tools_changed
+        self.mcp.on_tool_data_changed = self._on_tool_data_changed
+        self.mcp.start_refresh()
+
+    def _build_executor(self):
+        pre_model_hook = HistoryLimiter(self.llm) if AGENT_HISTORY_TOKENS > 0 else None
         self.agent_executor: Runnable = create_react_agent(
             model=self.llm,
             tools=self.tools,
             checkpointer=self.checkpointer, 
-            prompt=role 
+            prompt=self.role,
+            pre_model_hook=pre_model_hook
         )
-        print("Agent created")
+
+    def _on_tools_changed(self, tools: List[BaseTool]):
+        """
+        The MCP tool catalogue has changed: the agent is rebuilt with the new tools.
+        The conversations are kept in the checkpointer.
+        """
+        self.tools = tools
+        self._build_executor()
+        logger.info(f"Agent rebuilt with {len(tools)} tools")
+        self._on_tool_data_changed(None)
+
+    def _on_tool_data_changed(self, tool: str = None):
+        """
+        The data of a tool (or of every tool) may have changed: the cached answers
+        built with it are no longer valid.
+        """
+        answer_cache = get_answer_cache()
+        if answer_cache:
+            answer_cache.invalidate(tool)
+
+    def read_only(self, tool: str) -> bool:
+        """
+        Whether a tool has no side effects (see MCPSession.read_only).
+        """
+        return self.mcp.read_only(tool)
 
     async def _load_mcp_tools(self) -> List[BaseTool]:
-        client = MultiServerMCPClient(
-            {
-                "servant": {
-                    "url": MCP_URL,
-                    "transport": "sse",
-                }
-            }
-        )
-        return await client.get_tools()
+        """
+        Open the persistent MCP session and load the (cached) tool catalogue.
+        """
+        await self.mcp.connect()
+        await self.mcp.list_tools()
+        return self.mcp.langchain_tools()
+
+    async def end_thread(self, thread_id: str):
+        """
+        Remove the checkpoints of a finished conversation (e.g. when the call ends).
+        """
+        await self.checkpointer.adelete_thread(thread_id)
+
+    async def checkpoint(self, thread_id: str):
+        """
+        Current checkpoint of the conversation, to restore it later (see rollback).
+        Returns None for a new conversation.
+        """
+        state = await self.agent_executor.aget_state({"configurable": {"thread_id": thread_id}})
+        return state.config if state.values else None
+
+    async def rollback(self, thread_id: str, checkpoint):
+        """
+        Restore the conversation to a previous checkpoint, discarding the messages of the
+        turns processed after it (e.g. a speculative turn that has been cancelled).
+        """
+        if checkpoint is None:
+            await self.checkpointer.adelete_thread(thread_id)
+        else:
+            # The checkpoint is copied as the latest one of the thread
+            await self.agent_executor.aupdate_state(checkpoint, None)
+        logger.info(f"Thread {thread_id} rolled back")
+
+    async def remember(self, thread_id: str, message: str, answer: str):
+        """
+        Add a turn answered without the agent (e.g. from the answer cache) to the
+        conversation, so the next questions are answered with that context.
+        """
+        config = {"configurable": {"thread_id": thread_id}}
+        await self.agent_executor.aupdate_state(
+            config, {"messages": [HumanMessage(content=message), AIMessage(content=answer)]}, as_node="agent")
+
+    async def cancel_turn(self, thread_id: str):
+        """
+        Leave the conversation consistent after a turn has been cancelled (e.g. the user
+        interrupts the answer). If the turn was cancelled while the tools were running,
+        the pending tool calls are closed; otherwise the next LLM call would be rejected.
+        """
+        config = {"configurable": {"thread_id": thread_id}}
+        state = await self.agent_executor.aget_state(config)
+        messages = state.values.get("messages", [])
+        if not messages or not isinstance(messages[-1], AIMessage) or not messages[-1].tool_calls:
+            return
+
+        tool_messages = [ToolMessage(content=INTERRUPTED_TOOL_RESULT, tool_call_id=tool_call["id"],
+                                     name=tool_call["name"])
+                         for tool_call in messages[-1].tool_calls]
+        await self.agent_executor.aupdate_state(config, {"messages": tool_messages}, as_node="tools")
+        logger.info(f"Thread {thread_id}: {len(tool_messages)} interrupted tool calls closed")
+
+    async def close(self):
+        await self.mcp.close()
 
 
-    async def execute(self, message: str) -> str:
-        print(f"\n--- Running with input: '{message}' ---")
+    async def execute(self, message: str, thread_id: str = "1") -> str:
+        """
+        Process the user message in the given conversation thread (one thread per call).
+        """
+        logger.info(f"--- Running with input: '{message}' ---")
         
         inputs = {"input": message}
         try:
-            config = {"configurable": {"thread_id": "1"}}
+            config = {"configurable": {"thread_id": thread_id}}
             result = await self.agent_executor.ainvoke({"messages": [{"role": "user", "content": message}]}, config)
-            print(result['messages'][-1].content)
+            logger.info(result['messages'][-1].content)
             final_message = result['messages'][-1].content
 
             if final_message:
@@ -69,9 +280,74 @@ class MCPAgent:
             else:
                 return "I cannot get a clear answer from the agent."
         except Exception as e:
-            print(f"Error in agent: {e}")
+            logger.error(f"Error in agent: {e}")
             return f"Lo siento, hubo un error al procesar tu solicitud: {e}"
 
+    async def _held_tools(self, config, hold_tools: asyncio.Event):
+        """
+        The agent stopped before running the tools (see astream): wait for hold_tools
+        if a tool with side effects is requested. Returns False if the agent is done.
+        """
+        state = await self.agent_executor.aget_state(config)
+        if not state.next:
+            return False
+        tools = [tool_call["name"] for tool_call in state.values["messages"][-1].tool_calls]
+        if not hold_tools.is_set() and not all(self.read_only(tool) for tool in tools):
+            logger.info(f"Thread {config['configurable']['thread_id']}: tool calls held ({', '.join(tools)})")
+            await hold_tools.wait()
+        return True
+
+    async def astream(self, message: str, thread_id: str = "1",
+                      hold_tools: asyncio.Event = None) -> AsyncIterator[AgentEvent]:
+        """
+        Streaming variant of execute. The LLM tokens are streamed from the agent and
+        every sentence is yielded as soon as it is complete, together with the
+        progress of the tool calls.
+
+        With hold_tools (e.g. a speculative turn), the tools with side effects are not
+        called until the event is set; the read-only tools are called at once.
+        """
+        logger.info(f"--- Streaming with input: '{message}' ---")
+
+        sentences = SentenceBuffer()
+        answered = False
+        try:
+            config = {"configurable": {"thread_id": thread_id}}
+            inputs = {"messages": [{"role": "user", "content": message}]}
+            while True:
+                holding = hold_tools is not None and not hold_tools.is_set()
+                async for chunk, metadata in self.agent_executor.astream(
+                        inputs, config, stream_mode="messages", interrupt_before=["tools"] if holding else None):
+                    # Only the answer of the agent node is spoken (not e.g. the summary of the HistoryLimiter)
+                    if isinstance(chunk, AIMessageChunk) and metadata.get("langgraph_node") == "agent":
+                        for tool_call in chunk.tool_call_chunks:
+                            if tool_call.get("name"):
+                                yield AgentEvent(AgentEvent.TOOL_CALL, tool_call["name"])
+
+                        for sentence in sentences.feed(chunk.text()):
+                            answered = True
+                            yield AgentEvent(AgentEvent.SENTENCE, sentence)
+
+                    elif isinstance(chunk, ToolMessage):
+                        yield AgentEvent(AgentEvent.TOOL_RESULT, chunk.name)
+
+                if not holding or not await self._held_tools(config, hold_tools):
+                    break
+                # Resume the agent, stopped before the tools
+                inputs = None
+
+            for sentence in sentences.flush():
+                answered = True
+                yield AgentEvent(AgentEvent.SENTENCE, sentence)
+
+            if not answered:
+                yield AgentEvent(AgentEvent.ERROR, "empty answer")
+                yield AgentEvent(AgentEvent.SENTENCE, "I cannot get a clear answer from the agent.")
+        except Exception as e:
+            logger.error(f"Error in agent: {e}")
+            yield AgentEvent(AgentEvent.ERROR, str(e))
+            yield AgentEvent(AgentEvent.SENTENCE, f"Lo siento, hubo un error al procesar tu solicitud: {e}")
+
 
 async def main():
     print("Creating agent instance...")
@@ -88,9 +364,12 @@ async def main():
     print(f"\nUsuario: {user_message_1}")
     print(f"Agente: {response_1}")
 
+    await agent.close()
+
 
 
 # Bloque para ejecutar como script
 if __name__ == "__main__":
+    configure_logging()
     asyncio.run(main())
 
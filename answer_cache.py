@@ -0,0 +1,186 @@
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Opt-in cache of the agent answers to the repeated questions of the callers
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', 'false').lower() in ('1', 'true', 'yes')
+# Time to live of the answers per intent, as a list of intent=ttl_seconds. The intent is the tool used
+# by the answer ("chat" when no tool is used) and "default" applies to the rest, e.g. "get_temperature=60,chat=3600"
+ANSWER_CACHE_TTLS = os.getenv('ANSWER_CACHE_TTLS', 'default=300')
+# Maximum number of answers kept in memory
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+# Words and expressions ignored when comparing the questions (comma separated)
+ANSWER_CACHE_FILLERS = os.getenv('ANSWER_CACHE_FILLERS',
+                                 'a ver,o sea,por favor,porfa,oye,mira,pues,bueno,vale,hola,buenas,'
+                                 'eh,em,ehm,mm,mmm,ah,um,uh,hmm,please,hey,hi,hello,well')
+
+CHAT_INTENT = "chat"
+DEFAULT_INTENT = "default"
+
+# Hesitation sounds with any number of repeated letters (ehhh, mmmm, ummm)
+_HESITATION = re.compile(r"\b(?:e+h+|e+m+|m+|a+h+|u+m+|u+h+|h+m+)\b")
+
+
+def _fillers_pattern(fillers: str):
+    words = sorted({filler.strip() for filler in fillers.split(',') if filler.strip()}, key=len, reverse=True)
+    if not words:
+        return None
+    return re.compile(r"\b(?:" + "|".join(re.escape(word) for word in words) + r")\b")
+
+
+_FILLERS = _fillers_pattern(ANSWER_CACHE_FILLERS)
+
+
+def normalize_transcript(text: str, fillers=_FILLERS) -> str:
+    """
+    Comparable form of a transcribed question: lower case, without accents, punctuation
+    and filler words, e.g. "¡Oye! ¿Me puedes decir la temperatura exterior, por favor?"
+    is "me puedes decir la temperatura exterior".
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^\w\s]", " ", text)
+    text = _HESITATION.sub(" ", text)
+    if fillers is not None:
+        text = fillers.sub(" ", text)
+    return " ".join(text.split())
+
+
+class CachedAnswer(NamedTuple):
+    """
+    Answer of the agent to a question:
+    - sentences: the answer, sentence by sentence, as it was synthesized. The audio
+      of every sentence is kept in the TTS cache.
+    - tools: the tools used to build the answer.
+    - intent: the intent that selected the time to live.
+    - expires: expiration time (time.monotonic).
+    """
+    sentences: tuple
+    tools: frozenset
+    intent: str
+    expires: float
+
+    @property
+    def text(self) -> str:
+        return " ".join(self.sentences)
+
+
+class AnswerCache:
+    """
+    In-memory cache of the agent answers, keyed on the normalized transcript of the
+    question (see normalize_transcript).
+
+    A hit answers the question without calling the LLM, the tools or the TTS: the
+    sentences of the answer are still in the TTS cache. Every answer expires after
+    the time to live of its intent: the tool used to build it (the shortest one when
+    several tools are used), or "chat" when no tool is used.
+
+    The answers are removed when the data of their tools changes (see invalidate):
+    a tool returns a different result, a tool with side effects is called, or the
+    tool catalogue changes. Only the first question of a conversation is answered
+    from (and stored in) the cache, as the later questions depend on the previous
+    turns: a "sí" can confirm any action.
+    """
+
+    def __init__(self, ttls: dict = None, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.ttls = ttls if ttls is not None else {DEFAULT_INTENT: 300.0}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Incremented by every invalidation, so the answers built meanwhile are not stored
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def ttl(self, intent: str) -> float:
+        return self.ttls.get(intent, self.ttls.get(DEFAULT_INTENT, 0.0))
+
+    def intent(self, tools) -> tuple[str, float]:
+        """
+        Intent of an answer built with the given tools, and its time to live.
+        """
+        if not tools:
+            return CHAT_INTENT, self.ttl(CHAT_INTENT)
+        return min(((tool, self.ttl(tool)) for tool in tools), key=lambda item: item[1])
+
+    def get(self, question: str):
+        """
+        Cached answer to a question, or None if it is not in the cache (or expired).
+        """
+        key = normalize_transcript(question)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        logger.info(f"Answer cache hit ({entry.intent}): '{key}'")
+        return entry
+
+    def put(self, question: str, sentences, tools=(), generation: int = None):
+        """
+        Store the answer to a question. The answer is not stored if the cache has been
+        invalidated since `generation` (the value of self.generation when the answer
+        was requested), or if the time to live of its intent is 0.
+        """
+        if generation is not None and generation != self.generation:
+            return None
+        key = normalize_transcript(question)
+        sentences = tuple(sentences)
+        if not key or not sentences:
+            return None
+
+        intent, ttl = self.intent(set(tools))
+        if ttl <= 0:
+            return None
+
+        entry = self._entries[key] = CachedAnswer(sentences, frozenset(tools), intent, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.debug(f"Answer cached ({intent}, {ttl}s): '{key}'")
+        return entry
+
+    def invalidate(self, tool: str = None):
+        """
+        Remove the answers built with a tool, or every answer.
+        """
+        self.generation += 1
+        if tool is None:
+            removed = len(self._entries)
+            self._entries.clear()
+        else:
+            keys = [key for key, entry in self._entries.items() if tool in entry.tools]
+            for key in keys:
+                del self._entries[key]
+            removed = len(keys)
+        if removed:
+            logger.info(f"Answer cache: {removed} answers invalidated ({tool or 'all'})")
+
+
+_answer_cache = None
+
+
+def get_answer_cache() -> AnswerCache:
+    """
+    Shared answer cache, or None if it is disabled (ANSWER_CACHE=false).
+    """
+    global _answer_cache
+    if _answer_cache is None and ANSWER_CACHE:
+        from mcp_session import parse_ttls
+        _answer_cache = AnswerCache(parse_ttls(ANSWER_CACHE_TTLS))
+    return _answer_cache
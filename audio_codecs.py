@@ -0,0 +1,304 @@
+import io
+import logging
+import math
+import wave
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    import soundfile
+except ImportError:  # optional dependency (pip install soundfile)
+    soundfile = None
+
+CONTENT_TYPES = {
+    "wav": "audio/wav",
+    "flac": "audio/flac",
+    "opus": "audio/ogg; codecs=opus",
+}
+
+# libsndfile format and subtype of every compressed codec
+_SOUNDFILE_FORMATS = {
+    "flac": ("FLAC", "PCM_16"),
+    "opus": ("OGG", "OPUS"),
+}
+
+# Codecs that can be encoded while the utterance is captured. The header of a streamed
+# FLAC has no length (total_samples=0), which libsndfile and other decoders reject
+_STREAMED_CODECS = ("opus",)
+
+
+def available_codecs() -> list[str]:
+    """
+    Codecs that can be encoded in this process. WAV is always available; FLAC and
+    Opus require soundfile (libsndfile).
+    """
+    codecs = ["wav"]
+    if soundfile is not None:
+        formats = soundfile.available_formats()
+        for codec, (audio_format, subtype) in _SOUNDFILE_FORMATS.items():
+            if audio_format in formats and subtype in soundfile.available_subtypes(audio_format):
+                codecs.append(codec)
+    return codecs
+
+
+def negotiate(preferred) -> str:
+    """
+    First codec of the preference list (e.g. of an STT backend) that can be encoded,
+    falling back to WAV.
+    """
+    available = available_codecs()
+    for codec in preferred:
+        if codec in available:
+            return codec
+        logger.warning(f"Audio codec {codec} not available, trying the next one")
+    return "wav"
+
+
+def read_wav(audio) -> tuple[np.ndarray, int]:
+    """
+    16-bit PCM samples and sample rate of a WAV file path or in-memory WAV data.
+    """
+    source = audio if isinstance(audio, str) else io.BytesIO(audio)
+    with wave.open(source, 'rb') as wav_file:
+        samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+        return samples, wav_file.getframerate()
+
+
+def wav_data(pcm, sample_rate: int = 16000) -> bytes:
+    """
+    In-memory WAV data of 16-bit mono PCM audio.
+    """
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return output.getvalue()
+
+
+def encode(audio, codec: str):
+    """
+    Encode an utterance (WAV file path or in-memory WAV data) with the given codec.
+    WAV data is returned as it is, without copying it. If the encoding fails, the
+    WAV data is returned instead.
+
+    Returns the encoded data and the codec actually used.
+    """
+    if codec != "wav":
+        try:
+            samples, sample_rate = read_wav(audio)
+            output = io.BytesIO()
+            audio_format, subtype = _SOUNDFILE_FORMATS[codec]
+            soundfile.write(output, samples, sample_rate, format=audio_format, subtype=subtype)
+            return output.getvalue(), codec
+        except Exception as e:
+            logger.warning(f"Error encoding the audio as {codec}, sending WAV: {e}")
+
+    if isinstance(audio, str):
+        with open(audio, 'rb') as audio_file:
+            return audio_file.read(), "wav"
+    return audio, "wav"
+
+
+class Resampler:
+    """
+    Streaming sample rate converter of 16-bit mono PCM (windowed sinc interpolation).
+
+    The interpolation filters are computed once, one per phase of the conversion ratio,
+    so converting a block of audio is a gather and a dot product per output sample.
+    The last input samples are kept between blocks, so a stream can be converted
+    block by block (e.g. the captured frames) with no discontinuities.
+    """
+
+    def __init__(self, from_rate: int, to_rate: int, taps: int = 16):
+        divisor = math.gcd(from_rate, to_rate)
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.up = to_rate // divisor
+        self.down = from_rate // divisor
+        # Low-pass below the lowest Nyquist frequency; the filter is longer when downsampling
+        cutoff = min(1.0, self.up / self.down) * 0.95
+        self.half_width = math.ceil(taps / cutoff)
+        self._offsets = np.arange(-self.half_width + 1, self.half_width + 1)
+        x = self._offsets[None, :] - np.arange(self.up)[:, None] / self.up
+        window = 0.5 + 0.5 * np.cos(np.pi * np.clip(x / self.half_width, -1, 1))
+        weights = cutoff * np.sinc(cutoff * x) * window
+        self._weights = (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+        self.reset()
+
+    def reset(self):
+        # Input history: _history[0] is the input sample number _start
+        self._history = np.zeros(self.half_width - 1, dtype=np.float32)
+        self._start = -(self.half_width - 1)
+        self._received = 0
+        self._next = 0
+
+    def process(self, samples, final: bool = False) -> np.ndarray:
+        """
+        Convert the next block of samples. The output is delayed by half the filter
+        length; with final, the end of the stream is flushed.
+        """
+        samples = np.asarray(samples, dtype=np.int16).reshape(-1)
+        if self.up == self.down:
+            return samples
+
+        self._received += samples.size
+        buffer = np.concatenate((self._history, samples.astype(np.float32)))
+        if final:
+            buffer = np.concatenate((buffer, np.zeros(self.half_width, dtype=np.float32)))
+            # Output samples up to the end of the input
+            end = -(-self._received * self.up // self.down)
+        else:
+            # Output samples whose filter has every input sample
+            last = self._start + buffer.size - self.half_width - 1
+            end = -(-(last + 1) * self.up // self.down) if last >= 0 else self._next
+
+        outputs = np.arange(self._next, max(end, self._next))
+        positions = outputs * self.down // self.up
+        phases = outputs * self.down % self.up
+        indexes = (positions - self._start)[:, None] + self._offsets[None, :]
+        result = np.einsum('ij,ij->i', buffer[indexes], self._weights[phases])
+
+        self._next += outputs.size
+        keep = max(self._next * self.down // self.up - self.half_width + 1 - self._start, 0)
+        self._history = buffer[keep:]
+        self._start += keep
+        return np.clip(np.rint(result), -32768, 32767).astype(np.int16)
+
+
+def resample(samples: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    """
+    Convert a whole clip of 16-bit mono PCM to another sample rate.
+    """
+    samples = np.asarray(samples, dtype=np.int16).reshape(-1)
+    if from_rate == to_rate:
+        return samples
+    resampler = Resampler(from_rate, to_rate)
+    # Blocks of one second bound the memory used by the interpolation
+    blocks = [resampler.process(samples[start:start + from_rate]) for start in range(0, samples.size, from_rate)]
+    blocks.append(resampler.process(samples[:0], final=True))
+    return np.concatenate(blocks)
+
+
+def to_mono(samples: np.ndarray, channels: int) -> np.ndarray:
+    """
+    Mix interleaved 16-bit PCM down to mono.
+    """
+    if channels == 1:
+        return samples
+    frames = samples[:samples.size // channels * channels].reshape(-1, channels)
+    return np.rint(frames.mean(axis=1)).astype(np.int16)
+
+
+def convert(data, sample_rate: int, to_rate: int, channels: int = 1) -> np.ndarray:
+    """
+    Convert raw 16-bit PCM (bytes-like or int16 array) to mono at the given sample rate.
+    """
+    samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2) if not isinstance(data, np.ndarray) else data
+    return resample(to_mono(samples, channels), sample_rate, to_rate)
+
+
+def read_audio(path: str, to_rate: int) -> np.ndarray:
+    """
+    Read a 16-bit WAV file as mono PCM at the given sample rate.
+    """
+    with wave.open(path, 'rb') as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit PCM files are supported")
+        channels = wav_file.getnchannels()
+        rate = wav_file.getframerate()
+        data = wav_file.readframes(wav_file.getnframes())
+    return convert(data, rate, to_rate, channels)
+
+
+class _StreamWriter:
+    """
+    Write-only file object of a StreamEncoder: the bytes appended at the end of the
+    file are collected to be sent. The header updates written on close (seeking back
+    to the start) are dropped, as that data has already been sent.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+        self.size = 0
+        self.position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        if self.position == self.size:
+            self.pending += data
+            self.size += len(data)
+        self.position += len(data)
+        self.size = max(self.size, self.position)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        return b""
+
+    def take(self) -> bytes:
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+
+class StreamEncoder:
+    """
+    Incremental encoder of an utterance while it is being captured (see STTStream).
+    The compressed data is produced as soon as the encoder completes each block.
+    The stream length is unknown when the header is written, as in a streamed WAV.
+
+    The codecs that cannot be streamed (FLAC, see _STREAMED_CODECS) are encoded
+    once, when the utterance is complete.
+    """
+
+    def __init__(self, codec: str, sample_rate: int = 16000):
+        audio_format, subtype = _SOUNDFILE_FORMATS[codec]
+        if soundfile is None:
+            raise RuntimeError("soundfile is not installed")
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self._pcm = None
+        self._writer = _StreamWriter()
+        if codec in _STREAMED_CODECS:
+            self._file = soundfile.SoundFile(self._writer, mode='w', samplerate=sample_rate, channels=1,
+                                             format=audio_format, subtype=subtype)
+        else:
+            self._pcm = bytearray()
+
+    def encode(self, pcm) -> bytes:
+        """
+        Encode a new piece of 16-bit mono PCM audio. Returns the compressed data available so far.
+        """
+        if self._pcm is not None:
+            self._pcm += pcm
+            return b""
+        self._file.write(np.frombuffer(pcm, dtype=np.int16))
+        return self._writer.take()
+
+    def finish(self) -> bytes:
+        """
+        Flush the encoder. Returns the last compressed data.
+        """
+        if self._pcm is not None:
+            audio_format, subtype = _SOUNDFILE_FORMATS[self.codec]
+            output = io.BytesIO()
+            soundfile.write(output, np.frombuffer(self._pcm, dtype=np.int16), self.sample_rate,
+                            format=audio_format, subtype=subtype)
+            return output.getvalue()
+        self._file.close()
+        return self._writer.take()
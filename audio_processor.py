@@ -1,28 +1,67 @@
 import asyncio
-import json
+import collections
+import logging
+import struct
+import threading
 import time
 import numpy as np
 import wave
 import os
-from openai import OpenAI
+from typing import NamedTuple
 
-import requests
+from answer_cache import get_answer_cache
+from audio_codecs import convert, read_audio, wav_data
+from metrics import TurnMetrics
+from stt import STTStream, get_stt_scheduler
+from text_utils import split_sentences
+from tts_cache import TTSCache, TTS_CACHE_MAX_MB
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 LLM_API_KEY = os.getenv('LLM_API_KEY')
 LLM_PROMPT = os.getenv('LLM_PROMPT')
-STT_APIKEY = os.getenv('STT_APIKEY')
-STT_URL = os.getenv('STT_URL')
+LLM_BASE_URL = os.getenv('LLM_BASE_URL') or None
+# Maximum number of sentences synthesized at the same time
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', '3'))
+TTS_MODEL = "tts-1"
+TTS_VOICE = "nova"
+TTS_SPEED = 1.0
+# Audio requested to the TTS provider: pcm (raw 16-bit mono PCM at TTS_PCM_RATE, no WAV parsing) or wav
+TTS_FORMAT = os.getenv('TTS_FORMAT', 'pcm').lower()
+TTS_PCM_RATE = 24000
+# Clock rate of the call audio (PJMEDIA conference bridge). The synthesized audio is converted
+# once to this rate, so it is played without resampling. Use the codec rate, e.g. 8000 for G.711
+AUDIO_CLOCK_RATE = int(os.getenv('AUDIO_CLOCK_RATE', '16000'))
+# End of turn detection (see Endpointer)
+ENDPOINT_ONSET_MS = int(os.getenv('ENDPOINT_ONSET_MS', '100'))
+ENDPOINT_HANGOVER_MS = int(os.getenv('ENDPOINT_HANGOVER_MS', '250'))
+# Provisional pause, before the end of the turn is confirmed (used by the speculative turns)
+ENDPOINT_PAUSE_MS = int(os.getenv('ENDPOINT_PAUSE_MS', '120'))
+ENDPOINT_PRE_ROLL_MS = int(os.getenv('ENDPOINT_PRE_ROLL_MS', '200'))
+# Speech is detected when the frame energy exceeds the noise floor by this factor
+ENDPOINT_NOISE_FACTOR = float(os.getenv('ENDPOINT_NOISE_FACTOR', '4.0'))
+# Majority vote of the frame decisions over this window, so isolated frames (clicks) are ignored
+ENDPOINT_SMOOTHING_MS = int(os.getenv('ENDPOINT_SMOOTHING_MS', '60'))
+# While our own audio is played, the speech must exceed the noise floor by this extra factor (echo suppression)
+ENDPOINT_PLAYBACK_FACTOR = float(os.getenv('ENDPOINT_PLAYBACK_FACTOR', '8.0'))
+# Speech frames have a ZCR between these values (mains hum is below, line noise and clicks above)
+VAD_MIN_ZCR = float(os.getenv('VAD_MIN_ZCR', '0.01'))
+VAD_MAX_ZCR = float(os.getenv('VAD_MAX_ZCR', '0.25'))
+# Speech frames have a spectral flatness below this value (white noise and clicks are above it)
+VAD_MAX_FLATNESS = float(os.getenv('VAD_MAX_FLATNESS', '0.4'))
 
 class VAD: 
     def __init__(self, 
                  sample_rate: int = 16000, 
                  frame_len_ms: int = 20,
                  energy_threshold: float = 0.005, # Umbral de energía (0.0 a 1.0, normalizado)
-                 zcr_threshold: float = 0.05     # Umbral de ZCR (0.0 a 1.0, normalizado)
+                 zcr_threshold: float = VAD_MAX_ZCR,  # ZCR máximo (0.0 a 1.0, normalizado)
+                 min_zcr: float = VAD_MIN_ZCR,  # ZCR mínimo
+                 flatness_threshold: float = VAD_MAX_FLATNESS  # Planitud espectral máxima (0.0 a 1.0)
                 ):
         """
         VAD (Voice Activity Detection) initialization.
@@ -30,7 +69,13 @@ class VAD:
         This class is responsible for detecting voice activity in audio streams.
         Once detected, it can be used to trigger actions such as recording or processing audio.
 
-        Current implementation is based on energy detection for each audio frame. Please review the method is_speech for further details.
+        A frame is speech when three features agree (see classify):
+        - energy above the threshold (fixed here, adaptive in the Endpointer),
+        - zero-crossing rate (ZCR) between min_zcr and zcr_threshold: mains hum crosses
+          zero much less often than a voice, line noise and clicks much more often,
+        - spectral flatness in the telephone band below flatness_threshold: voiced
+          speech is harmonic, while line noise and clicks have a flat spectrum (and so
+          has the background noise in that band, when the hum is below it).
         See https://en.wikipedia.org/wiki/Voice_activity_detection
         """
         self.sample_rate = sample_rate
@@ -40,35 +85,53 @@ class VAD:
 
         self.energy_threshold = energy_threshold
         self.zcr_threshold = zcr_threshold
-
-        print(f"VAD (WAV Input, Custom) initialized: SR={self.sample_rate}Hz, Frame={self.frame_len_ms}ms, "
-              f"Energy_Th={self.energy_threshold:.4f}, ZCR_Th={self.zcr_threshold:.2f}")
-
-    def _calculate_energy(self, audio_frame_np: np.ndarray) -> float:
+        self.min_zcr = min_zcr
+        self.flatness_threshold = flatness_threshold
+        self._window = np.hanning(self.frame_len_samples).astype(np.float32)
+        # Telephone band (300-3400Hz) of the spectral flatness
+        bin_hz = sample_rate / self.frame_len_samples
+        self._band = slice(max(1, int(300 / bin_hz)), int(3400 / bin_hz) + 1)
+
+        logger.info(f"VAD (WAV Input, Custom) initialized: SR={self.sample_rate}Hz, Frame={self.frame_len_ms}ms, "
+              f"Energy_Th={self.energy_threshold:.4f}, ZCR={self.min_zcr:.2f}-{self.zcr_threshold:.2f}, "
+              f"Flatness_Th={self.flatness_threshold:.2f}")
+
+    def _calculate_energy(self, frames: np.ndarray) -> np.ndarray:
         """
-        Calculate the energy of an audio frame.
-        It is normalized to a range of -1.0 to 1.0 for the calculation.
+        Calculate the energy of each audio frame (one frame per row).
+        Samples are normalized to a range of -1.0 to 1.0 for the calculation.
+        The sum of squares is accumulated in int64 to avoid a float copy of the frames.
         """
-        if audio_frame_np.size == 0:
-            return 0.0
-        normalized_frame = audio_frame_np / 32768.0 
-        energy = np.sum(normalized_frame**2) / normalized_frame.size
-        return energy
+        if frames.shape[-1] == 0:
+            return np.zeros(frames.shape[:-1], dtype=np.float32)
+        sum_squares = np.einsum('...i,...i->...', frames, frames, dtype=np.int64)
+        return (sum_squares / (32768.0 * 32768.0 * frames.shape[-1])).astype(np.float32)
 
-    def _calculate_zcr(self, audio_frame_np: np.ndarray) -> float:
+    def _calculate_zcr(self, frames: np.ndarray) -> np.ndarray:
         """
-        Calculate the Zero-Crossing Rate (ZCR) of an audio frame.
+        Calculate the Zero-Crossing Rate (ZCR) of each audio frame (one frame per row).
+        A crossing is counted every time the sign bit changes between consecutive samples.
         """
-        if audio_frame_np.size < 2:
-            return 0.0
-        zcr = np.sum(np.abs(np.diff(np.sign(audio_frame_np)))) / (2.0 * audio_frame_np.size)
-        return zcr
+        if frames.shape[-1] < 2:
+            return np.zeros(frames.shape[:-1], dtype=np.float32)
+        negative = np.signbit(frames)
+        crossings = np.count_nonzero(negative[..., 1:] != negative[..., :-1], axis=-1)
+        return (crossings / frames.shape[-1]).astype(np.float32)
 
-    def is_speech(self, wav_file_path: str) -> list[bool]:
+    def _calculate_flatness(self, frames: np.ndarray) -> np.ndarray:
         """
-        Analyze a WAV file for speech activity.
+        Calculate the spectral flatness of each audio frame (one frame per row): the
+        geometric mean of the power spectrum divided by its arithmetic mean, in the
+        telephone band. It is close to 0 for a harmonic sound and around 0.6 for white noise.
+        """
+        if frames.shape[0] == 0:
+            return np.zeros(0, dtype=np.float32)
+        power = np.abs(np.fft.rfft(frames * self._window, axis=-1))[:, self._band] ** 2 + 1e-10
+        return (np.exp(np.log(power).mean(axis=-1)) / power.mean(axis=-1)).astype(np.float32)
 
-        This method returns a list of boolean values indicating the presence of speech in each frame.
+    def _read_wav(self, wav_file_path: str) -> np.ndarray:
+        """
+        Read the whole content of a WAV file as an int16 array.
         """
         if not os.path.exists(wav_file_path):
             raise FileNotFoundError(f"File not found: {wav_file_path}")
@@ -83,119 +146,648 @@ class VAD:
                     raise ValueError(f"File must be mono, 16-bit PCM, and {self.sample_rate}Hz. "
                                      f"Found: {num_channels} channels, {sample_width*8}-bit, {sample_rate}Hz.")
 
-                speech_activity_per_frame = []
-                while True:
-                    data_bytes = wf.readframes(self.frame_len_samples)
-                    if not data_bytes:
-                        break
+                return np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+        except wave.Error as e:
+            raise IOError(f"Error reading WAV file: {e}")
 
-                    # Pad with silence if the last frame is shorter
-                    if len(data_bytes) < self.bytes_per_frame:
-                        data_bytes += b'\x00' * (self.bytes_per_frame - len(data_bytes))
-                    
-                    audio_frame_np = np.frombuffer(data_bytes, dtype=np.int16)
-                    energy = self._calculate_energy(audio_frame_np)
-                    zcr = self._calculate_zcr(audio_frame_np)
+    def frames(self, audio) -> np.ndarray:
+        """
+        Split the audio into a (frames x samples) int16 matrix.
 
-                    # Voice detection logic: simply if the energy exceeds the threshold.
-                    # You can add more complexity here if needed (e.g. combining with ZCR).
-                    is_active_frame = energy > self.energy_threshold
+        The audio can be a WAV file path, a bytes-like object with 16-bit PCM data,
+        a 1-D int16 array or an already framed 2-D array. The matrix is a view over
+        the original buffer; only an incomplete last frame is copied to pad it with silence.
+        """
+        if isinstance(audio, str):
+            pcm = self._read_wav(audio)
+        elif isinstance(audio, np.ndarray):
+            pcm = audio
+        else:
+            pcm = np.frombuffer(audio, dtype=np.int16)
+
+        if pcm.ndim == 2 and pcm.shape[1] == self.frame_len_samples:
+            return pcm
+
+        pcm = pcm.reshape(-1)
+        num_full_frames = pcm.size // self.frame_len_samples
+        full_frames = pcm[:num_full_frames * self.frame_len_samples].reshape(num_full_frames, self.frame_len_samples)
+
+        tail = pcm[num_full_frames * self.frame_len_samples:]
+        if tail.size == 0:
+            return full_frames
+
+        # Pad with silence if the last frame is shorter
+        last_frame = np.zeros((1, self.frame_len_samples), dtype=np.int16)
+        last_frame[0, :tail.size] = tail
+        return np.concatenate((full_frames, last_frame))
+
+    def frame_features(self, audio) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Compute the energy, the ZCR and the spectral flatness of every frame of the audio.
 
-                    speech_activity_per_frame.append(is_active_frame)
+        Returns three float32 arrays with one value per frame.
+        """
+        frames = self.frames(audio)
+        return self._calculate_energy(frames), self._calculate_zcr(frames), self._calculate_flatness(frames)
 
-                print(f"Analyzed {len(speech_activity_per_frame)} frames from file '{wav_file_path}'.")
-                return speech_activity_per_frame
+    def voiced(self, zcr: np.ndarray, flatness: np.ndarray) -> np.ndarray:
+        """
+        Frames whose ZCR and spectral flatness are those of a voice, whatever their energy.
+        """
+        return (zcr >= self.min_zcr) & (zcr <= self.zcr_threshold) & (flatness < self.flatness_threshold)
 
-        except wave.Error as e:
-            raise IOError(f"Error reading WAV file: {e}")
+    def classify(self, energy: np.ndarray, zcr: np.ndarray, flatness: np.ndarray,
+                 energy_threshold: float = None) -> np.ndarray:
+        """
+        Combined speech decision of every frame (see frame_features).
+        """
+        if energy_threshold is None:
+            energy_threshold = self.energy_threshold
+        return (energy > energy_threshold) & self.voiced(zcr, flatness)
+
+    def analyze(self, audio) -> np.ndarray:
+        """
+        Analyze a whole audio buffer (see frames for the supported inputs) for speech activity.
+
+        This method returns a boolean array indicating the presence of speech in each frame.
+        Voice detection logic: the energy exceeds the threshold and the ZCR and the
+        spectral flatness are those of a voice (see classify).
+        """
+        return self.classify(*self.frame_features(audio))
+
+    def is_speech(self, wav_file_path: str) -> np.ndarray:
+        """
+        Analyze a WAV file for speech activity.
+
+        This method returns a boolean array indicating the presence of speech in each frame.
+        """
+        try:
+            speech_activity_per_frame = self.analyze(wav_file_path)
+        except (FileNotFoundError, ValueError, IOError):
+            raise
         except Exception as e:
             raise RuntimeError(f"An unexpected error occurred during VAD analysis: {e}")
 
+        logger.debug(f"Analyzed {len(speech_activity_per_frame)} frames from file '{wav_file_path}'.")
+        return speech_activity_per_frame
+
     def reset(self):
         """No reset is required for file-based VAD, as it does not maintain state
         between calls to `is_speech` with different files."""
-        print("VAD reset (no-op for WAV-based VAD).")
+        logger.debug("VAD reset (no-op for WAV-based VAD).")
 
 
-async def generate_output(input_text, client) -> str:
+class UtteranceBuffer:
     """
-    Generate a response based on the input text using the provided agent.
+    Growable in-memory WAV file for one utterance.
+
+    The PCM frames are appended as soon as they are analyzed, right after a reserved
+    WAV header. When the utterance is complete, the header is written once and the
+    whole buffer is handed over as a memoryview, without re-reading or copying the audio.
     """
-    return await client.execute(input_text)
 
+    HEADER_SIZE = 44
 
-async def process_audio(input_file, agent) -> str:
+    def __init__(self, sample_rate: int = 16000):
+        self.sample_rate = sample_rate
+        self._buffer = bytearray(self.HEADER_SIZE)
+
+    def append(self, pcm):
+        """
+        Append 16-bit mono PCM data (bytes-like object or int16 array).
+        """
+        self._buffer += memoryview(pcm).cast('B')
+
+    def truncate(self, size: int):
+        """
+        Drop every PCM byte after the first `size` bytes.
+        """
+        del self._buffer[self.HEADER_SIZE + size:]
+
+    def __len__(self):
+        return len(self._buffer) - self.HEADER_SIZE
+
+    def tail(self, start: int) -> bytes:
+        """
+        Copy of the PCM data after the first `start` bytes.
+        """
+        return bytes(self._buffer[self.HEADER_SIZE + start:])
+
+    def pcm(self) -> memoryview:
+        """
+        PCM data accumulated so far, without the WAV header.
+        """
+        return memoryview(self._buffer)[self.HEADER_SIZE:]
+
+    def snapshot(self) -> bytes:
+        """
+        Copy of the complete WAV file so far. The buffer can keep growing.
+        """
+        view = self.wav()
+        try:
+            return bytes(view)
+        finally:
+            view.release()
+
+    def wav(self) -> memoryview:
+        """
+        Write the WAV header and return the complete WAV file.
+        The buffer cannot be resized while the returned memoryview is alive.
+        """
+        data_size = len(self)
+        struct.pack_into('<4sI4s4sIHHIIHH4sI', self._buffer, 0,
+                         b'RIFF', 36 + data_size, b'WAVE',
+                         b'fmt ', 16, 1, 1, self.sample_rate, self.sample_rate * 2, 2, 16,
+                         b'data', data_size)
+        return memoryview(self._buffer)
+
+
+class PCMRingBuffer:
     """
-    Process the audio file and generate a response using the agent.
-    This function handles the entire lifecycle of audio processing:
-    1. Speech-to-text transcription
-    2. Generating a response by using the agent.
-    3. Text-to-speech synthesis and generation of the audio file.
+    Fixed-size ring buffer of 16-bit PCM frames.
+
+    The capture port pushes frames from the PJMEDIA media thread and the call
+    polling loop pops them from the asyncio thread, so every access is protected
+    by a lock. Storage is preallocated once; when the consumer falls behind, the
+    oldest frames are overwritten and counted in `dropped_frames`.
+    """
+
+    def __init__(self, frame_len_samples: int = 320, capacity_frames: int = 250):
+        self.frame_len_samples = frame_len_samples
+        self.bytes_per_frame = frame_len_samples * 2
+        self.capacity_frames = capacity_frames
+        self._frames = np.zeros((capacity_frames, frame_len_samples), dtype=np.int16)
+        self._read = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.dropped_frames = 0
+
+    def push(self, frame_bytes: bytes):
+        """
+        Store one frame. Short frames are padded with silence, longer ones truncated.
+        """
+        samples = np.frombuffer(frame_bytes, dtype=np.int16,
+                                count=min(len(frame_bytes) // 2, self.frame_len_samples))
+        with self._lock:
+            write = (self._read + self._count) % self.capacity_frames
+            slot = self._frames[write]
+            slot[:samples.size] = samples
+            slot[samples.size:] = 0
+            if self._count == self.capacity_frames:
+                self._read = (self._read + 1) % self.capacity_frames
+                self.dropped_frames += 1
+            else:
+                self._count += 1
+
+    def pop_all(self) -> np.ndarray:
+        """
+        Remove and return every pending frame, oldest first, as a (frames x samples) matrix.
+        """
+        with self._lock:
+            indexes = (self._read + np.arange(self._count)) % self.capacity_frames
+            frames = self._frames.take(indexes, axis=0)
+            self._read = (self._read + self._count) % self.capacity_frames
+            self._count = 0
+        return frames
+
+    def __len__(self):
+        with self._lock:
+            return self._count
 
-    This method returns the path to the generated audio file.
+
+class EndpointEvent(NamedTuple):
+    """
+    Event produced by the Endpointer.
+    - type: START (the user starts speaking), PAUSE (provisional pause of the user),
+      RESUME (the user speaks again after a PAUSE) or END (the user has stopped speaking).
+    - index: index of the frame that produced the event, in the analyzed frames.
     """
+    type: str
+    index: int
 
-    url = STT_URL
+    START = "start"
+    PAUSE = "pause"
+    RESUME = "resume"
+    END = "end"
 
-    ai_token = STT_APIKEY
-    headers = {
-        "Authorization": f"Bearer {ai_token}",
-        "Content-Type": "audio/wav"
-    }
 
-    input_text = "texto por defecto"
-    with open(input_file, 'rb') as audio_data:
-        response = requests.post(url, headers=headers, data=audio_data)
+class Endpointer:
+    """
+    Frame-level end of turn detection.
+
+    Every frame is compared with an adaptive noise floor, estimated per call: the floor
+    follows the energy of the non-speech frames (quickly downwards, slowly upwards), and
+    a frame is speech when its energy exceeds the floor by noise_factor and its ZCR and
+    spectral flatness are those of a voice (see VAD.voiced). The decisions are smoothed
+    by a majority vote over smoothing_ms, so a click or a short burst of noise does not
+    count as speech.
+
+    While our own audio is being played (see playing), the threshold is raised by
+    playback_factor and the noise floor is frozen: the echo of the answer is not taken
+    as the user speaking, while a user speaking over it (barge-in) is still detected.
+
+    The speech starts after onset_ms
+    of continuous speech frames and ends after hangover_ms of continuous silence, so the
+    end of the turn is detected hangover_ms after the user stops speaking. A provisional
+    PAUSE is notified after pause_ms of silence (if shorter than the hangover), and
+    RESUME if the user speaks again before the end of the turn.
+
+    The first pre_roll_ms of audio before the onset belong to the utterance, so the
+    first syllable is not clipped (see pre_roll_frames).
+    """
 
-        response.raise_for_status()  # Lanza una excepción HTTPError para respuestas 4xx/5xx
+    def __init__(self, vad: VAD,
+                 onset_ms: int = ENDPOINT_ONSET_MS,
+                 hangover_ms: int = ENDPOINT_HANGOVER_MS,
+                 pause_ms: int = ENDPOINT_PAUSE_MS,
+                 pre_roll_ms: int = ENDPOINT_PRE_ROLL_MS,
+                 noise_factor: float = ENDPOINT_NOISE_FACTOR,
+                 smoothing_ms: int = ENDPOINT_SMOOTHING_MS,
+                 playback_factor: float = ENDPOINT_PLAYBACK_FACTOR,
+                 min_energy: float = 1e-6,
+                 floor_down: float = 0.2,
+                 floor_up: float = 0.01):
+        self.vad = vad
+        self.onset_frames = max(1, onset_ms // vad.frame_len_ms)
+        self.hangover_frames = max(1, hangover_ms // vad.frame_len_ms)
+        self.pause_frames = max(1, pause_ms // vad.frame_len_ms)
+        self.pre_roll_frames = pre_roll_ms // vad.frame_len_ms
+        self.noise_factor = noise_factor
+        self.smoothing_frames = max(1, smoothing_ms // vad.frame_len_ms)
+        self.playback_factor = playback_factor
+        self.min_energy = min_energy
+        self.floor_down = floor_down
+        self.floor_up = floor_up
+        # The VAD threshold is the starting point of the noise floor
+        self.noise_floor = vad.energy_threshold / noise_factor
+        self.in_speech = False
+        self.paused = False
+        self.playing = False
+        self.speech_run = 0
+        self.silence_run = 0
+        self._recent = collections.deque(maxlen=self.smoothing_frames)
+
+    @property
+    def threshold(self) -> float:
+        threshold = max(self.noise_floor * self.noise_factor, self.min_energy)
+        return threshold * self.playback_factor if self.playing else threshold
+
+    def process(self, audio) -> tuple[np.ndarray, list[EndpointEvent]]:
+        """
+        Analyze the next frames of the stream (see VAD.frames for the supported inputs).
 
-        stt_body = response.text
-        segments = stt_body.split("\n}")
-        
-        item = segments[-2]
-        stt = json.loads(item + "}")
-        input_text = stt['text']     
+        Returns the speech decision of every frame and the endpoint events.
+        """
+        return self.process_features(*self.vad.frame_features(audio))
 
+    def process_features(self, energies: np.ndarray, zcr: np.ndarray,
+                         flatness: np.ndarray) -> tuple[np.ndarray, list[EndpointEvent]]:
+        """
+        Same as process, with the features of the frames already computed (see
+        VAD.frame_features), e.g. by an audio worker process.
+        """
+        voiced = self.vad.voiced(zcr, flatness)
+        speech = np.zeros(energies.size, dtype=bool)
+        events = []
+
+        for index, (energy, is_voiced) in enumerate(zip(energies.tolist(), voiced.tolist())):
+            is_speech = is_voiced and energy > self.threshold
+            if not is_speech and not self.playing:
+                rate = self.floor_down if energy < self.noise_floor else self.floor_up
+                self.noise_floor += rate * (energy - self.noise_floor)
+
+            self._recent.append(is_speech)
+            speech[index] = is_speech = 2 * sum(self._recent) > len(self._recent)
+
+            if is_speech:
+                self.speech_run += 1
+                self.silence_run = 0
+            else:
+                self.speech_run = 0
+                self.silence_run += 1
+
+            if not self.in_speech:
+                if self.speech_run >= self.onset_frames:
+                    self.in_speech = True
+                    events.append(EndpointEvent(EndpointEvent.START, index))
+            elif self.silence_run >= self.hangover_frames:
+                self.in_speech = False
+                self.paused = False
+                events.append(EndpointEvent(EndpointEvent.END, index))
+            elif self.paused and is_speech:
+                self.paused = False
+                events.append(EndpointEvent(EndpointEvent.RESUME, index))
+            elif not self.paused and self.silence_run == self.pause_frames < self.hangover_frames:
+                self.paused = True
+                events.append(EndpointEvent(EndpointEvent.PAUSE, index))
+
+        return speech, events
+
+
+_openai_client = None
+
+
+def get_openai_client() -> 'AsyncOpenAI':
+    """
+    Shared asynchronous OpenAI client. It is created once and reused in every turn,
+    so the HTTP connections to the provider are kept alive.
+    The openai package is imported on first use, to keep the startup fast.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(api_key=LLM_API_KEY, base_url=LLM_BASE_URL)
+    return _openai_client
 
-    try:
-        client = OpenAI(api_key=LLM_API_KEY)
-    except Exception as e:
-        return f"Error al inicializar el cliente de OpenAI: {e}"
 
-    print(f"Building the output from the input: '{input_text}'")
-    output_text = await generate_output(input_text, agent)
+async def generate_sentences(input_text, client, thread_id: str = "1", turn: TurnMetrics = None,
+                             events: list = None, hold_tools: asyncio.Event = None):
+    """
+    Stream the response of the agent, sentence by sentence, as soon as every sentence is complete.
+    The duration of every LLM step and tool call is recorded in the turn metrics.
+    The other events of the agent (tool calls, errors) are appended to `events`, when it is given.
+    The tools with side effects are not called until hold_tools is set, when it is given.
+    """
+    from agent import AgentEvent
+
+    step_start = time.monotonic()
+    tool_starts = {}
+    async for event in client.astream(input_text, thread_id=thread_id, hold_tools=hold_tools):
+        now = time.monotonic()
+        if event.type == AgentEvent.SENTENCE:
+            if turn:
+                turn.mark("llm_first_sentence")
+            yield event.content
+            continue
+
+        logger.info(f"Agent {event.type}: {event.content}")
+        if events is not None:
+            events.append(event)
+        if not turn:
+            continue
+        if event.type == AgentEvent.TOOL_CALL:
+            if not tool_starts:
+                turn.add("llm_step", now - step_start)
+            tool_starts[event.content] = now
+        elif event.type == AgentEvent.TOOL_RESULT and event.content in tool_starts:
+            turn.add(f"tool_{event.content}", now - tool_starts.pop(event.content))
+            step_start = now
+
+    if turn:
+        turn.add("llm_step", time.monotonic() - step_start)
+
+
+async def transcribe(input_file) -> str:
+    """
+    Speech-to-text transcription of the user audio.
+    The input is either a streaming transcription already in progress (see STTStream),
+    a WAV file path or in-memory WAV data. The utterances are queued in the shared STT
+    scheduler, with the utterances of every other call. The input can also be a
+    transcription task already started (see the speculative turns).
+    """
+    if isinstance(input_file, STTStream):
+        return await input_file.finish()
+    if isinstance(input_file, asyncio.Future):
+        return await input_file
 
+    return await get_stt_scheduler().transcribe(input_file)
 
-    timestr = time.strftime("%Y%m%d%H%M%S")
-    nombre_archivo_salida = f"chat_files/ai_generated_{timestr}.wav"
 
+_tts_cache = None
+
+
+def get_tts_cache():
+    """
+    Shared cache of synthesized speech, or None if it is disabled (TTS_CACHE_MAX_MB=0).
+    """
+    global _tts_cache
+    if _tts_cache is None and TTS_CACHE_MAX_MB > 0:
+        _tts_cache = TTSCache()
+    return _tts_cache
+
+
+def _write_call_audio(audio: bytes, output_file: str, sample_rate: int = AUDIO_CLOCK_RATE):
+    """
+    Convert the synthesized audio (see TTS_FORMAT) once to a mono 16-bit WAV file at the
+    call clock rate.
+    """
+    if TTS_FORMAT == "pcm":
+        samples = convert(audio, TTS_PCM_RATE, sample_rate)
+    else:
+        with open(output_file, 'wb') as wav_file:
+            wav_file.write(audio)
+        samples = read_audio(output_file, sample_rate)
+
+    with open(output_file, 'wb') as wav_file:
+        wav_file.write(wav_data(samples.tobytes(), sample_rate))
+
+
+async def _synthesize_to_file(text: str, output_file: str) -> str:
+    client = get_openai_client()
+
+    async with client.audio.speech.with_streaming_response.create(
+        model=TTS_MODEL,
+        voice=TTS_VOICE,
+        input=text,
+        response_format=TTS_FORMAT,
+        speed=TTS_SPEED
+    ) as speech_response:
+        audio = await speech_response.read()
+
+    await asyncio.to_thread(_write_call_audio, audio, output_file)
+    logger.debug(f"Audio generado exitosamente en: {output_file}")
+    return output_file
+
+
+async def synthesize(text: str, output_file: str) -> str:
+    """
+    Text-to-speech synthesis of a text into a WAV file at the call clock rate.
+    When the TTS cache is enabled, the audio is read from (or stored into) the cache
+    and the returned path is the cached file instead of output_file.
+    """
+    cache = get_tts_cache()
+    if cache is None:
+        return await _synthesize_to_file(text, output_file)
+
+    key = TTSCache.key(text, TTS_MODEL, TTS_VOICE, TTS_SPEED, "wav", AUDIO_CLOCK_RATE)
+    return await cache.get_or_create(key, lambda temp_path: _synthesize_to_file(text, temp_path))
+
+
+async def prewarm_tts(phrases: list[str]) -> list[str]:
+    """
+    Synthesize a list of frequent phrases into the TTS cache. Each phrase is split into
+    sentences, as it is done for the agent answers, so the cached entries match.
+
+    This method returns the paths of the cached audio files.
+    """
+    cache = get_tts_cache()
+    if cache is None:
+        return []
+
+    sentences = [sentence for phrase in phrases for sentence in split_sentences(phrase)]
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+    async def prewarm_sentence(sentence):
+        async with semaphore:
+            try:
+                return await synthesize(sentence, None)
+            except Exception as e:
+                logger.warning(f"Error prewarming the TTS cache with '{sentence}': {e}")
+
+    paths = await asyncio.gather(*[prewarm_sentence(sentence) for sentence in sentences])
+    logger.info(f"TTS cache prewarmed with {len(sentences)} sentences ({cache.size} bytes)")
+    return [path for path in paths if path]
+
+
+async def synthesize_stream(sentences, enqueue, output_dir: str = "chat_files",
+                            max_concurrency: int = TTS_CONCURRENCY, turn: TurnMetrics = None) -> list[str]:
+    """
+    Synthesize the sentences of an async iterable (e.g. the agent answer being streamed)
+    concurrently, starting each synthesis as soon as the sentence is available.
+    Each audio file is handed over to `enqueue` in the sentence order as soon as it
+    is ready, so the first sentence can be played while the rest are still being
+    generated and synthesized.
+
+    This method returns the paths of the generated audio files.
+    """
+    timestr = time.strftime("%Y%m%d%H%M%S")
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = asyncio.Queue()
+    started = []
+
+    async def synthesize_sentence(index, sentence):
+        async with semaphore:
+            start = time.monotonic()
+            output_file = await synthesize(sentence, os.path.join(output_dir, f"ai_generated_{timestr}_{index}.wav"))
+            if turn:
+                turn.add("tts", time.monotonic() - start)
+            return output_file
+
+    async def produce():
+        index = 0
+        async for sentence in sentences:
+            task = asyncio.create_task(synthesize_sentence(index, sentence))
+            started.append(task)
+            tasks.put_nowait(task)
+            index += 1
+        tasks.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    output_files = []
     try:
-        speech_response = client.audio.speech.create(
-            model="tts-1",
-            voice="nova",
-            input=output_text,
-            response_format="wav",
-            speed=1.0
-        )
+        while True:
+            task = await tasks.get()
+            if task is None:
+                break
+            try:
+                output_file = await task
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error durante la generación de audio con OpenAI: {e}")
+                continue
+            if turn:
+                turn.mark("first_audio_ready")
+            enqueue(output_file)
+            output_files.append(output_file)
+        await producer
+    finally:
+        producer.cancel()
+        for task in started:
+            task.cancel()
+
+    return output_files
+
+
+async def process_audio(input_file, agent, enqueue, session_id: str = "1", output_dir: str = "chat_files",
+                        turn: TurnMetrics = None, hold_tools: asyncio.Event = None) -> list[str]:
+    """
+    Process the audio (a WAV file path, in-memory WAV data, an STTStream or a transcription task) and generate a response using the agent.
+    This function handles the entire lifecycle of audio processing:
+    1. Speech-to-text transcription
+    2. Generating a response by using the agent. The answer is streamed sentence by sentence.
+    3. Text-to-speech synthesis and generation of the audio files, one per sentence.
+       Every sentence is synthesized as soon as the agent completes it, and every audio
+       file is passed to `enqueue` (e.g. the playback queue) as soon as it is ready.
+
+    The session_id selects the agent conversation and the audio files are generated
+    in output_dir, so several calls can be processed at the same time.
 
-        speech_response.stream_to_file(nombre_archivo_salida)
+    None of these steps blocks the event loop: the STT and OpenAI calls use
+    asynchronous clients with pooled connections.
 
-        print(f"Audio generado exitosamente en: {nombre_archivo_salida}")
-        return nombre_archivo_salida
+    The timing of every step is recorded in the turn metrics (a new TurnMetrics
+    is created when it is not provided).
+
+    With hold_tools (see the speculative turns), the tools with side effects requested
+    by the agent are not called until the event is set.
+
+    When the answer cache is enabled (see ANSWER_CACHE), a repeated first question of a
+    conversation is answered from the cache, skipping the agent and the TTS: the cached
+    sentences are found in the TTS cache.
+
+    This method returns the paths to the generated audio files.
+    """
+    turn = turn or TurnMetrics(session_id)
+    try:
+        with turn.span("stt"):
+            input_text = await transcribe(input_file)
+
+        answer_cache = get_answer_cache()
+        # Only the first question of a conversation is answered from (and stored in) the cache:
+        # the later ones depend on the previous turns (e.g. "sí" to confirm an action)
+        first_question = answer_cache is not None and await agent.checkpoint(session_id) is None
+        if first_question:
+            cached = answer_cache.get(input_text)
+            if cached:
+                turn.mark("answer_cache_hit")
+                await agent.remember(session_id, input_text, cached.text)
+                return await synthesize_stream(_iterate(cached.sentences), enqueue, output_dir, turn=turn)
+            generation = answer_cache.generation
+
+        logger.info(f"Building the output from the input: '{input_text}'")
+        events = []
+        sentences = generate_sentences(input_text, agent, thread_id=session_id, turn=turn, events=events,
+                                       hold_tools=hold_tools)
+        if not first_question:
+            return await synthesize_stream(sentences, enqueue, output_dir, turn=turn)
+
+        from agent import AgentEvent
+
+        answer = []
+        output_files = await synthesize_stream(_record(sentences, answer), enqueue, output_dir, turn=turn)
+        tools = {event.content for event in events if event.type == AgentEvent.TOOL_CALL}
+        # The failed answers and the answers of the tools with side effects are not cached
+        if (not any(event.type == AgentEvent.ERROR for event in events)
+                and all(agent.read_only(tool) for tool in tools)):
+            answer_cache.put(input_text, answer, tools, generation)
+        return output_files
+    finally:
+        turn.complete("processing")
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def _record(items, recorded: list):
+    """
+    Pass through the items of an async iterable, appending them to `recorded`.
+    """
+    async for item in items:
+        recorded.append(item)
+        yield item
 
-    except Exception as e:
-        return f"Error durante la generación de audio con OpenAI: {e}"
-    
-    return nombre_archivo_salida
 
 def concat_wav_files(input_files, output_file):
-    print("concat_wav_files", input_files, output_file)
+    logger.debug(f"concat_wav_files {input_files} {output_file}")
 
     data = []
 
     # Abrir cada archivo y extraer los frames
     for infile in input_files:
-        print("processing", infile)
+        logger.debug(f"processing {infile}")
         with wave.open(infile, 'rb') as wav:
             if not data:
                 params = wav.getparams()  # Guardar formato original
@@ -207,4 +799,4 @@ def concat_wav_files(input_files, output_file):
         for frames in data:
             out_wav.writeframes(frames)
 
-    print(f"✅ Archivo combinado guardado como: {output_file}")
+    logger.debug(f"✅ Archivo combinado guardado como: {output_file}")
@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Worker processes of the audio analysis: 0 analyzes the audio in the main process, auto uses one per core
+AUDIO_WORKERS = os.getenv('AUDIO_WORKERS', '0').lower()
+
+
+def _attach(name: str) -> SharedMemory:
+    """
+    Attach to a shared memory block created (and unlinked) by the main process.
+    """
+    try:
+        return SharedMemory(name, track=False)
+    except TypeError:
+        # Python < 3.13: the spawned workers share the resource tracker of the main process
+        return SharedMemory(name)
+
+
+# --- Worker process side ---
+
+# Shared memory blocks of the frames: header (written, processed, consumed frame counters),
+# ring of frames and ring of features (energy, ZCR and spectral flatness of every frame)
+_HEADER = 3
+_WRITTEN, _PROCESSED, _CONSUMED = range(_HEADER)
+_FEATURES = 3
+# Interval of the analysis workers when no call has new frames
+ANALYSIS_INTERVAL = 0.005
+
+_vads = {}
+
+
+def _vad(sample_rate: int, frame_len_samples: int):
+    key = (sample_rate, frame_len_samples)
+    if key not in _vads:
+        from audio_processor import VAD
+        _vads[key] = VAD(sample_rate=sample_rate, frame_len_ms=frame_len_samples * 1000 // sample_rate)
+    return _vads[key]
+
+
+def _layout(buffer, capacity_frames: int, frame_len_samples: int):
+    """
+    Views of the header, frames and features of a shared frames block.
+    """
+    header = np.ndarray(_HEADER, dtype=np.int64, buffer=buffer)
+    offset = header.nbytes
+    frames = np.ndarray((capacity_frames, frame_len_samples), dtype=np.int16, buffer=buffer, offset=offset)
+    offset += frames.nbytes
+    features = np.ndarray((capacity_frames, _FEATURES), dtype=np.float64, buffer=buffer, offset=offset)
+    return header, frames, features
+
+
+def _block_size(capacity_frames: int, frame_len_samples: int) -> int:
+    return 8 * _HEADER + capacity_frames * (2 * frame_len_samples + 8 * _FEATURES)
+
+
+class _AttachedFrames:
+    """
+    Worker side of a SharedFrames block: the frames written since the last analysis
+    are analyzed in place and their features are written back.
+    """
+
+    def __init__(self, name: str, capacity_frames: int, frame_len_samples: int, sample_rate: int):
+        self.shm = _attach(name)
+        self.capacity = capacity_frames
+        self.vad = _vad(sample_rate, frame_len_samples)
+        self.header, self.frames, self.features = _layout(self.shm.buf, capacity_frames, frame_len_samples)
+
+    def analyze(self) -> bool:
+        written = int(self.header[_WRITTEN])
+        # The frames already consumed by the main process (analyzed there) are skipped
+        start = max(int(self.header[_PROCESSED]), int(self.header[_CONSUMED]))
+        if written <= start:
+            return False
+        indexes = np.arange(start, written) % self.capacity
+        self.features[indexes] = np.column_stack(self.vad.frame_features(self.frames[indexes]))
+        # The counter is updated once the features are written
+        self.header[_PROCESSED] = written
+        return True
+
+    def close(self):
+        self.header = self.frames = self.features = None
+        self.shm.close()
+
+
+def _analysis_loop(control):
+    """
+    Main loop of an analysis worker: the frames of the attached calls are analyzed as
+    soon as they are written, with no message per poll. The control queue only carries
+    the calls being attached (and detached).
+    """
+    blocks = {}
+    while True:
+        while not control.empty() or not blocks:
+            message = control.get()
+            if message is None:
+                for block in blocks.values():
+                    block.close()
+                return
+            command, name, *params = message
+            try:
+                if command == "attach":
+                    blocks[name] = _AttachedFrames(name, *params)
+                elif name in blocks:
+                    blocks.pop(name).close()
+            except Exception as e:
+                logger.warning(f"Audio worker: error attaching {name}: {e}")
+
+        busy = False
+        for name, block in list(blocks.items()):
+            try:
+                busy = block.analyze() or busy
+            except Exception as e:
+                # Only this call is affected: the main process analyzes its frames after a delay
+                logger.warning(f"Audio worker: error analyzing {name}, detached: {e}")
+                blocks.pop(name).close()
+        if not busy:
+            time.sleep(ANALYSIS_INTERVAL)
+
+
+def _encode(name: str, size: int, codec: str):
+    from audio_codecs import encode
+
+    shm = _attach(name)
+    try:
+        data, codec = encode(bytes(shm.buf[:size]), codec)
+        return bytes(data), codec
+    finally:
+        shm.close()
+
+
+def _ready() -> int:
+    # Import the audio modules of the worker in advance
+    import audio_codecs  # noqa: F401
+    import audio_processor  # noqa: F401
+    return os.getpid()
+
+
+# --- Main process side ---
+
+class SharedFrames:
+    """
+    Shared memory block where a call passes its captured frames to an analysis worker.
+
+    The frames are copied into a ring and the worker writes the features of every frame
+    into a second ring, both in place: a poll is a copy and a few counter updates, with
+    no inter-process message, pickling or thread switch. The counters are updated after
+    the data they cover.
+
+    The features of the frames written in a poll are collected in the next one, so the
+    analysis is delayed by one poll. If the worker falls behind (max_lag_frames) or is
+    not running, the pending frames are analyzed in the main process instead.
+    """
+
+    def __init__(self, frame_len_samples: int, sample_rate: int, capacity_frames: int = 250,
+                 max_lag_frames: int = 10):
+        self.frame_len_samples = frame_len_samples
+        self.sample_rate = sample_rate
+        self.capacity = capacity_frames
+        self.max_lag_frames = max_lag_frames
+        self.shm = SharedMemory(create=True, size=_block_size(capacity_frames, frame_len_samples))
+        self.header, self.frames, self.features = _layout(self.shm.buf, capacity_frames, frame_len_samples)
+        self.header[:] = 0
+        self.written = 0
+        self.consumed = 0
+        # Worker process analyzing the block (see AudioWorkerPool.shared_frames)
+        self.analyzer = None
+        self._vad = None
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def exchange(self, frames: np.ndarray) -> tuple[np.ndarray, tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Pass the new (frames x samples) matrix to the worker and collect the frames
+        analyzed since the last exchange, with their energy, ZCR and spectral flatness
+        (see VAD.frame_features).
+        """
+        processed = int(self.header[_PROCESSED])
+        behind = self.written + len(frames) - max(processed, self.consumed)
+        if (behind > self.max_lag_frames or self.written + len(frames) - self.consumed > self.capacity
+                or (self.analyzer is not None and not self.analyzer.is_alive())):
+            return self._analyze_locally(frames)
+
+        indexes = np.arange(self.written, self.written + len(frames)) % self.capacity
+        self.frames[indexes] = frames
+        self.written += len(frames)
+        self.header[_WRITTEN] = self.written
+        return self._collect(processed)
+
+    def _collect(self, end: int):
+        indexes = np.arange(self.consumed, max(end, self.consumed)) % self.capacity
+        frames = self.frames[indexes]
+        features = self.features[indexes]
+        self.consumed += indexes.size
+        self.header[_CONSUMED] = self.consumed
+        return frames, (features[:, 0], features[:, 1], features[:, 2])
+
+    def _analyze_locally(self, frames: np.ndarray):
+        logger.debug(f"Audio worker behind by {self.written - self.consumed} frames, analyzing locally")
+        if self._vad is None:
+            self._vad = _vad(self.sample_rate, self.frame_len_samples)
+        processed, (energy, zcr, flatness) = self._collect(int(self.header[_PROCESSED]))
+        pending = self.frames[np.arange(self.consumed, self.written) % self.capacity]
+        self.consumed = self.written
+        self.header[_CONSUMED] = self.consumed
+
+        pending = np.concatenate((processed, pending, frames.reshape(-1, self.frame_len_samples)))
+        local = self._vad.frame_features(pending[len(processed):])
+        return pending, tuple(np.concatenate((done, new)) for done, new in zip((energy, zcr, flatness), local))
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header = self.frames = self.features = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+class AudioWorkerPool:
+    """
+    Pool of worker processes for the audio analysis, so the analysis of many calls
+    runs on every core instead of competing for the GIL with the PJSUA2 callbacks
+    and the asyncio loop.
+
+    Every call is attached to an analysis worker, which analyzes its frames through
+    shared memory (see SharedFrames) with no per-poll messages: the cost of a poll in
+    the main process is lower than the analysis itself. The compressed STT uploads
+    (see audio_codecs.encode) are encoded by a separate pool of processes.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # The workers are spawned: forking a process running the PJSUA2 threads is not safe
+        context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(workers, mp_context=context)
+        self._controls = [context.Queue() for _ in range(workers)]
+        self._analyzers = [context.Process(target=_analysis_loop, args=(control,), daemon=True)
+                           for control in self._controls]
+        self._attached = [set() for _ in range(workers)]
+        self._started = False
+
+    def _start_analyzers(self):
+        if not self._started:
+            self._started = True
+            for analyzer in self._analyzers:
+                analyzer.start()
+
+    def shared_frames(self, frame_len_samples: int, sample_rate: int) -> SharedFrames:
+        """
+        New shared frames block of a call, attached to the least loaded analysis worker.
+        """
+        self._start_analyzers()
+        shared = SharedFrames(frame_len_samples, sample_rate)
+        worker = min(range(self.workers), key=lambda index: len(self._attached[index]))
+        self._attached[worker].add(shared.name)
+        shared.analyzer = self._analyzers[worker]
+        self._controls[worker].put(("attach", shared.name, shared.capacity, frame_len_samples, sample_rate))
+        return shared
+
+    def release(self, shared: SharedFrames):
+        """
+        Detach the block of a finished call and free it.
+        """
+        for worker, names in enumerate(self._attached):
+            if shared.name in names:
+                names.discard(shared.name)
+                self._controls[worker].put(("detach", shared.name))
+        shared.close()
+
+    async def start(self):
+        """
+        Start every worker process in advance, so the first calls do not wait for them.
+        """
+        self._start_analyzers()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*[loop.run_in_executor(self._executor, _ready) for _ in range(self.workers)])
+        logger.info(f"Audio workers started: {len(self._analyzers)} analysis and {len(set(pids))} encoding processes")
+
+    async def encode(self, audio, codec: str):
+        """
+        Encode an utterance (in-memory WAV data) for the STT upload, see audio_codecs.encode.
+        """
+        audio = memoryview(audio).cast('B')
+        shm = SharedMemory(create=True, size=max(audio.nbytes, 1))
+        try:
+            shm.buf[:audio.nbytes] = audio
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, _encode, shm.name, audio.nbytes, codec)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        for control in self._controls:
+            control.put(None)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def worker_count(setting: str = AUDIO_WORKERS) -> int:
+    if setting == "auto":
+        return os.cpu_count() or 1
+    return int(setting)
+
+
+_audio_pool = None
+
+
+def get_audio_pool() -> AudioWorkerPool:
+    """
+    Shared pool of audio workers, or None if it is disabled (AUDIO_WORKERS=0).
+    """
+    global _audio_pool
+    if _audio_pool is None and worker_count() > 0:
+        _audio_pool = AudioWorkerPool(worker_count())
+    return _audio_pool
@@ -0,0 +1,736 @@
+"""
+Benchmark suite of the voice pipeline, without SIP or external services.
+
+- corpus: generates synthetic 16kHz speech/silence WAV files.
+- micro: micro-benchmarks of the audio processing (VAD, endpointer, segment concatenation, utterance assembly,
+  resampling and STT upload encoding, with the payload compression ratio).
+- vad: false-trigger and detection rates of the endpointer on a labelled synthetic corpus
+  (speech, line noise, clicks, hum, echo of our own audio), compared with the energy-only decision.
+- pool: throughput of the VAD analysis of many calls, in the main process or in the audio worker processes.
+- stt: throughput of the STT scheduler (queue shared by every call) with a fake backend.
+- e2e: end-to-end turns (process_audio with a real MCPAgent) against local stand-ins
+  of the STT service, the OpenAI API (LLM and TTS) and the MCP server, with a
+  configurable latency.
+
+Usage:
+    python benchmark.py corpus --output bench_corpus
+    python benchmark.py micro --repeat 200
+    python benchmark.py corpus --labelled --output vad_corpus
+    python benchmark.py vad --clips 50
+    python benchmark.py pool --calls 64 --workers 4
+    python benchmark.py stt --utterances 200 --latency-ms 300 --batch-size 8
+    python benchmark.py e2e --turns 50 --concurrency 8 --llm-latency-ms 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+# --- Synthetic corpus ---
+
+def synthetic_speech(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Speech-like signal: a harmonic voice with a varying pitch, modulated by a syllabic
+    envelope (~4Hz), plus some background noise.
+    """
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    f0 = rng.uniform(110, 220) * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(0.5, 2) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * rng.uniform(3, 5) * t + rng.uniform(0, np.pi)), 0.1, 1)
+    signal = 0.3 * voice * envelope + rng.normal(0, 0.005, t.size)
+    return np.clip(signal * 32767 * 0.5, -32768, 32767).astype(np.int16)
+
+
+def synthetic_silence(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE,
+                      noise_level: float = 0.002) -> np.ndarray:
+    """
+    Background noise only.
+    """
+    signal = rng.normal(0, noise_level, int(duration * sample_rate))
+    return np.clip(signal * 32767, -32768, 32767).astype(np.int16)
+
+
+def synthetic_utterance(rng: np.random.Generator, speech_seconds: float = 2.0, silence_seconds: float = 1.0) -> np.ndarray:
+    return np.concatenate((synthetic_silence(silence_seconds / 2, rng),
+                           synthetic_speech(speech_seconds, rng),
+                           synthetic_silence(silence_seconds / 2, rng)))
+
+
+def write_wav(path: str, pcm: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
+
+def wav_bytes(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> bytes:
+    with tempfile.TemporaryFile() as temp_file:
+        with wave.open(temp_file, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm.tobytes())
+        temp_file.seek(0)
+        return temp_file.read()
+
+
+def generate_corpus(output_dir: str, utterances: int = 20, segment_seconds: float = 0.5, seed: int = 0) -> list[str]:
+    """
+    Generate the corpus: for each utterance, the complete WAV file and its 0.5s segments
+    (as they were recorded by the former per-segment recorders).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    segment_samples = int(segment_seconds * SAMPLE_RATE)
+    files = []
+    for i in range(utterances):
+        pcm = synthetic_utterance(rng, speech_seconds=rng.uniform(1, 4))
+        path = os.path.join(output_dir, f"utterance_{i}.wav")
+        write_wav(path, pcm)
+        files.append(path)
+        for j in range(0, pcm.size // segment_samples):
+            write_wav(os.path.join(output_dir, f"utterance_{i}_segment_{j}.wav"),
+                      pcm[j * segment_samples:(j + 1) * segment_samples])
+    return files
+
+
+# --- Labelled corpus (false triggers) ---
+
+def synthetic_line_noise(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Bursts of loud white noise (line noise), as loud as speech.
+    """
+    signal = rng.normal(0, 0.002, int(duration * sample_rate))
+    for _ in range(rng.integers(1, 4)):
+        length = int(rng.uniform(0.2, 0.6) * sample_rate)
+        start = rng.integers(0, max(signal.size - length, 1))
+        signal[start:start + length] += rng.normal(0, rng.uniform(0.03, 0.1), signal[start:start + length].size)
+    return np.clip(signal * 32767, -32768, 32767).astype(np.int16)
+
+
+def synthetic_clicks(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Crackling line: dense clicks (short decaying impulses) over the background noise.
+    """
+    signal = rng.normal(0, 0.002, int(duration * sample_rate))
+    click = np.exp(-np.arange(int(0.002 * sample_rate)) / (0.0004 * sample_rate))
+    for position in np.cumsum(rng.exponential(sample_rate / 60, int(duration * 80))).astype(int):
+        if position + click.size >= signal.size:
+            break
+        signal[position:position + click.size] += rng.choice((-1, 1)) * rng.uniform(0.2, 0.8) * click
+    return np.clip(signal * 32767, -32768, 32767).astype(np.int16)
+
+
+def synthetic_hum(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Mains hum (50 or 60Hz and its harmonics) over the background noise.
+    """
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    mains = rng.choice((50, 60))
+    hum = sum(np.sin(2 * np.pi * k * mains * t + rng.uniform(0, np.pi)) / k for k in range(1, 4))
+    signal = rng.uniform(0.05, 0.2) * hum + rng.normal(0, 0.002, t.size)
+    return np.clip(signal * 32767, -32768, 32767).astype(np.int16)
+
+
+def mix(signal: np.ndarray, other: np.ndarray, gain: float) -> np.ndarray:
+    mixed = signal.astype(np.float64) + gain * other.astype(np.float64)
+    return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+
+def labelled_clip(label: str, rng: np.random.Generator) -> np.ndarray:
+    """
+    Clip of a corpus label: 1s of background noise (the noise floor settles), the event
+    (2s) and 0.5s of background noise.
+    """
+    duration = 2.0
+    if label == "speech":
+        event = synthetic_speech(duration, rng)
+    elif label == "speech_noisy":
+        # Speech with white noise, 10dB SNR
+        event = synthetic_speech(duration, rng)
+        event = mix(event, rng.normal(0, event.std() / 3.16, event.size), 1.0)
+    elif label == "barge_in":
+        # The user speaks over the echo of our own audio
+        event = mix(synthetic_speech(duration, rng), synthetic_speech(duration, rng), 0.1)
+    elif label == "echo":
+        # Residual echo of our own audio, 20dB below the speech level
+        event = mix(synthetic_silence(duration, rng), synthetic_speech(duration, rng), 0.1)
+    elif label == "line_noise":
+        event = synthetic_line_noise(duration, rng)
+    elif label == "clicks":
+        event = synthetic_clicks(duration, rng)
+    elif label == "hum":
+        event = synthetic_hum(duration, rng)
+    else:
+        event = synthetic_silence(duration, rng)
+    return np.concatenate((synthetic_silence(1.0, rng), event, synthetic_silence(0.5, rng)))
+
+
+# Label: (the clip contains user speech, our own audio is being played)
+CORPUS_LABELS = {
+    "speech": (True, False),
+    "speech_noisy": (True, False),
+    "barge_in": (True, True),
+    "silence": (False, False),
+    "line_noise": (False, False),
+    "clicks": (False, False),
+    "hum": (False, False),
+    "echo": (False, True),
+}
+
+
+def labelled_corpus(clips_per_label: int = 20, seed: int = 0) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    return [{"label": label, "speech": speech, "playing": playing, "pcm": labelled_clip(label, rng)}
+            for label, (speech, playing) in CORPUS_LABELS.items() for _ in range(clips_per_label)]
+
+
+def write_labelled_corpus(output_dir: str, clips_per_label: int = 20, seed: int = 0) -> int:
+    """
+    Write the labelled corpus: one WAV file per clip and labels.jsonl.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    clips = labelled_corpus(clips_per_label, seed)
+    with open(os.path.join(output_dir, "labels.jsonl"), 'w') as labels_file:
+        for i, clip in enumerate(clips):
+            name = f"{clip['label']}_{i}.wav"
+            write_wav(os.path.join(output_dir, name), clip["pcm"])
+            labels_file.write(json.dumps({"file": name, "label": clip["label"], "speech": clip["speech"],
+                                          "playing": clip["playing"]}) + "\n")
+    return len(clips)
+
+
+# --- Statistics ---
+
+def summarize(name: str, durations: list[float], elapsed: float = None) -> dict:
+    values = np.array(durations)
+    result = {
+        "name": name,
+        "count": int(values.size),
+        "mean_ms": float(values.mean() * 1000),
+        "p50_ms": float(np.percentile(values, 50) * 1000),
+        "p95_ms": float(np.percentile(values, 95) * 1000),
+        "p99_ms": float(np.percentile(values, 99) * 1000),
+    }
+    if elapsed:
+        result["throughput_per_s"] = values.size / elapsed
+    return result
+
+
+def print_results(results: list[dict]):
+    print(f"{'benchmark':<32}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'per s':>10}")
+    for result in results:
+        throughput = result.get("throughput_per_s")
+        print(f"{result['name']:<32}{result['count']:>7}{result['mean_ms']:>10.3f}{result['p50_ms']:>10.3f}"
+              f"{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+              f"{(f'{throughput:.1f}' if throughput else '-'):>10}")
+
+
+def timeit(function, repeat: int) -> tuple[list[float], float]:
+    durations = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - t0)
+    return durations, time.perf_counter() - start
+
+
+# --- Micro-benchmarks ---
+
+def run_micro(repeat: int, corpus_dir: str) -> list[dict]:
+    from audio_codecs import Resampler, available_codecs, encode, resample
+    from audio_processor import VAD, Endpointer, UtteranceBuffer, concat_wav_files
+
+    files = generate_corpus(corpus_dir, utterances=5)
+    vad = VAD(energy_threshold=0.0002)
+    segment_file = os.path.join(corpus_dir, "utterance_0_segment_0.wav")
+    segment_files = sorted(f for f in os.listdir(corpus_dir) if f.startswith("utterance_0_segment_"))
+    segment_files = [os.path.join(corpus_dir, f) for f in segment_files]
+    utterance = vad.frames(files[0])
+    concat_output = os.path.join(corpus_dir, "concat.wav")
+
+    def endpointer():
+        # Frame stream as polled by the call: a few frames at a time
+        detector = Endpointer(vad)
+        for start in range(0, len(utterance), 2):
+            detector.process(utterance[start:start + 2])
+
+    def join_audio():
+        # Same work as MyCall: frames appended as analyzed, then the WAV header is written
+        buffer = UtteranceBuffer(vad.sample_rate)
+        for frame in utterance:
+            buffer.append(frame)
+        return buffer.wav()
+
+    benchmarks = [
+        ("vad.is_speech (0.5s file)", lambda: vad.is_speech(segment_file)),
+        ("vad.is_speech (utterance)", lambda: vad.is_speech(files[0])),
+        ("vad.analyze (utterance)", lambda: vad.analyze(utterance)),
+        ("vad.frame_features (utterance)", lambda: vad.frame_features(utterance)),
+        ("endpointer (utterance)", endpointer),
+        ("concat_wav_files", lambda: concat_wav_files(segment_files, concat_output)),
+        ("join_audio", join_audio),
+    ]
+    tts_audio = synthetic_speech(3.0, np.random.default_rng(1), 24000)
+    capture = Resampler(8000, vad.sample_rate)
+    capture_frames = synthetic_speech(0.06, np.random.default_rng(2), 8000)
+    benchmarks += [
+        ("resample tts (3s, 24k->16k)", lambda: resample(tts_audio, 24000, 16000)),
+        ("resample capture (3 frames, 8k)", lambda: capture.process(capture_frames)),
+    ]
+    wav = join_audio()
+    for codec in available_codecs()[1:]:
+        ratio = len(wav) / len(encode(wav, codec)[0])
+        benchmarks.append((f"encode {codec} ({ratio:.1f}x smaller)", lambda codec=codec: encode(wav, codec)))
+
+    results = []
+    for name, function in benchmarks:
+        function()  # warm-up
+        durations, elapsed = timeit(function, repeat)
+        results.append(summarize(name, durations, elapsed))
+    return results
+
+
+# --- VAD false triggers ---
+
+def run_vad(args) -> list[dict]:
+    """
+    Count the turns started (START events) by the endpointer on every clip of the
+    labelled corpus, fed 3 frames at a time as in a call. The energy-only detector
+    is the endpointer without the ZCR and flatness gates, smoothing and echo suppression.
+    """
+    from audio_processor import VAD, Endpointer
+
+    detectors = {
+        "triggers": lambda: Endpointer(VAD(energy_threshold=0.0002)),
+        "energy_only": lambda: Endpointer(VAD(energy_threshold=0.0002, zcr_threshold=1.0, min_zcr=0,
+                                                     flatness_threshold=np.inf),
+                                          smoothing_ms=0, playback_factor=1.0),
+    }
+    clips = labelled_corpus(args.clips, args.seed)
+    results = []
+    for label, (speech, playing) in CORPUS_LABELS.items():
+        result = {"name": label, "speech": speech, "playing": playing, "clips": 0}
+        for clip in (clip for clip in clips if clip["label"] == label):
+            result["clips"] += 1
+            for name, detector in detectors.items():
+                endpointer = detector()
+                frames = endpointer.vad.frames(clip["pcm"])
+                started = False
+                for start in range(0, len(frames), 3):
+                    # Our own audio is played during the event, after the first second
+                    endpointer.playing = playing and 50 <= start < 150
+                    _, events = endpointer.process(frames[start:start + 3])
+                    started = started or any(event.type == event.START for event in events)
+                result[name] = result.get(name, 0) + started
+        for name in detectors:
+            result[name] /= result["clips"]
+        results.append(result)
+    return results
+
+
+def print_vad_results(results: list[dict]):
+    print(f"{'clips':<16}{'count':>7}{'speech':>8}{'turns started':>16}{'energy only':>14}")
+    for result in results:
+        print(f"{result['name']:<16}{result['clips']:>7}{('yes' if result['speech'] else 'no'):>8}"
+              f"{result['triggers']:>16.1%}{result['energy_only']:>14.1%}")
+    negatives = [result for result in results if not result["speech"]]
+    positives = [result for result in results if result["speech"]]
+    for name, title in (("triggers", "multi-feature"), ("energy_only", "energy only")):
+        false_triggers = sum(result[name] for result in negatives) / len(negatives)
+        detected = sum(result[name] for result in positives) / len(positives)
+        print(f"{title}: {false_triggers:.1%} false triggers, {detected:.1%} speech detected")
+
+
+# --- Audio worker pool ---
+
+async def run_pool(args) -> list[dict]:
+    """
+    Every call polls its frames at the pace of a real call (--frames every --poll-ms),
+    all the calls at once, analyzed in the main process and then by the worker processes.
+    The CPU time of the main process (the one running the SIP callbacks and the event
+    loop) is the cost the workers have to reduce.
+    """
+    from audio_processor import VAD
+    from audio_workers import AudioWorkerPool
+
+    vad = VAD(energy_threshold=0.0002)
+    rng = np.random.default_rng(0)
+    audio = vad.frames(synthetic_utterance(rng, 3.0, 1.0))
+
+    async def calls(name: str, analyze) -> dict:
+        durations = []
+
+        async def call(index):
+            for poll in range(args.polls):
+                start = (poll * args.frames) % (len(audio) - args.frames)
+                t0 = time.perf_counter()
+                analyze(index, audio[start:start + args.frames])
+                durations.append(time.perf_counter() - t0)
+                await asyncio.sleep(args.poll_ms / 1000)
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*[call(index) for index in range(args.calls)])
+        result = summarize(name, durations, time.perf_counter() - start)
+        result["main_cpu_s"] = time.process_time() - cpu
+        return result
+
+    results = [await calls(f"main process ({args.calls} calls)", lambda index, frames: vad.frame_features(frames))]
+
+    pool = AudioWorkerPool(args.workers)
+    await pool.start()
+    shared = [pool.shared_frames(vad.frame_len_samples, vad.sample_rate) for _ in range(args.calls)]
+    await asyncio.sleep(0.5)  # attachment of the blocks
+    results.append(await calls(f"{args.workers} workers ({args.calls} calls)",
+                               lambda index, frames: shared[index].exchange(frames)))
+    for block in shared:
+        pool.release(block)
+    pool.close()
+    return results
+
+
+# --- STT scheduler ---
+
+async def run_stt(args) -> list[dict]:
+    from stt import FakeSTTBackend, STTScheduler
+
+    rng = np.random.default_rng(0)
+    audios = [wav_bytes(synthetic_speech(rng.uniform(0.5, 5), rng)) for _ in range(args.utterances)]
+    backend = FakeSTTBackend(latency=args.latency_ms / 1000, max_batch_size=args.batch_size)
+    scheduler = STTScheduler(backend, max_concurrency=args.concurrency, batch_wait=args.batch_wait_ms / 1000)
+    durations = []
+
+    async def utterance(audio):
+        start = time.perf_counter()
+        await scheduler.transcribe(audio)
+        durations.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[utterance(audio) for audio in audios])
+    elapsed = time.perf_counter() - start
+    await scheduler.aclose()
+
+    result = summarize(f"stt ({backend.batches} batches)", durations, elapsed)
+    return [result]
+
+
+# --- Local stand-ins of the external services ---
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in of the STT service and of the OpenAI API (chat completions,
+    with streaming and tool calls, and audio speech).
+    """
+    protocol_version = "HTTP/1.1"
+    config = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith("/chat/completions"):
+            self._chat_completions(json.loads(body))
+        elif self.path.endswith("/audio/speech"):
+            self._speech(json.loads(body))
+        else:
+            self._stt()
+
+    def _stt(self):
+        time.sleep(self.config["stt_latency"])
+        text = self.config["transcript"]
+        self._send(f'{{\n  "text": "{text[:10]}"\n}}\n{{\n  "text": "{text}"\n}}\n'.encode(), "application/json")
+
+    def _speech(self, request: dict):
+        time.sleep(self.config["tts_latency"])
+        # 60ms of (silent) audio per character, at the provider sample rate
+        pcm = np.zeros(int(0.06 * len(request["input"]) * 24000), dtype=np.int16)
+        if request.get("response_format") == "pcm":
+            self._send(pcm.tobytes(), "audio/pcm")
+        else:
+            self._send(wav_bytes(pcm, 24000), "audio/wav")
+
+    def _chat_completions(self, request: dict):
+        time.sleep(self.config["llm_latency"])
+        messages = request["messages"]
+        use_tool = request.get("tools") and messages[-1]["role"] != "tool"
+        answer = self.config["answer"]
+
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": None if use_tool else answer}
+            if use_tool:
+                message["tool_calls"] = [self._tool_call(request)]
+            self._send(json.dumps({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": "gpt-4o",
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if use_tool else "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }).encode(), "application/json")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": "gpt-4o", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        if use_tool:
+            tool_call = self._tool_call(request)
+            tool_call["index"] = 0
+            event({"role": "assistant", "content": None, "tool_calls": [tool_call]})
+            event({}, "tool_calls")
+        else:
+            event({"role": "assistant", "content": ""})
+            for token in answer.split(" "):
+                time.sleep(self.config["llm_token_latency"])
+                event({"content": token + " "})
+            event({}, "stop")
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _tool_call(self, request: dict) -> dict:
+        name = request["tools"][0]["function"]["name"]
+        return {"id": "call_bench", "type": "function",
+                "function": {"name": name, "arguments": json.dumps({"place": "exterior"})}}
+
+
+def start_fake_services(config: dict) -> ThreadingHTTPServer:
+    handler = type("ConfiguredFakeServiceHandler", (FakeServiceHandler,), {"config": config})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_fake_mcp(port: int, latency: float):
+    """
+    Local MCP server (SSE transport) with a single tool.
+    """
+    from mcp.server.fastmcp import FastMCP
+    from mcp.types import ToolAnnotations
+
+    server = FastMCP("servant", host="127.0.0.1", port=port, log_level="WARNING")
+
+    @server.tool(annotations=ToolAnnotations(readOnlyHint=True))
+    async def get_temperature(place: str) -> str:
+        """Devuelve la temperatura actual de un lugar de la casa."""
+        await asyncio.sleep(latency)
+        return f"La temperatura en {place} es de 21 grados"
+
+    threading.Thread(target=lambda: asyncio.run(server.run_sse_async()), daemon=True).start()
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --- End-to-end turns ---
+
+async def run_turns(turns: int, concurrency: int, output_dir: str, new_calls: bool = False) -> list[dict]:
+    """
+    Turns of `concurrency` calls. With new_calls, every turn is the first question of a new call.
+    """
+    from agent import MCPAgent
+    from audio_processor import process_audio
+    from metrics import TurnMetrics
+
+    agent = MCPAgent()
+    await agent._ainitialize(role="Tú eres un asistente. Contesta siempre en español")
+
+    rng = np.random.default_rng(0)
+    audio = wav_bytes(synthetic_utterance(rng))
+    semaphore = asyncio.Semaphore(concurrency)
+    totals = []
+    first_audio = []
+
+    async def turn(index):
+        async with semaphore:
+            metrics = TurnMetrics(f"bench_{index}")
+            start = time.perf_counter()
+            session_id = f"bench_{index}" if new_calls else f"bench_{index % concurrency}"
+            await process_audio(audio, agent, lambda filename: None, session_id=session_id,
+                                output_dir=output_dir, turn=metrics)
+            totals.append(time.perf_counter() - start)
+            if "first_audio_ready" in metrics.marks:
+                first_audio.append(metrics.marks["first_audio_ready"])
+
+    await turn(-1)  # warm-up (connections, tool catalogue)
+    totals.clear()
+    first_audio.clear()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[turn(i) for i in range(turns)])
+    elapsed = time.perf_counter() - start
+    await agent.close()
+
+    results = [summarize("e2e turn", totals, elapsed)]
+    if first_audio:
+        results.append(summarize("e2e time to first audio", first_audio))
+    return results
+
+
+def run_e2e(args) -> list[dict]:
+    config = {
+        "stt_latency": args.stt_latency_ms / 1000,
+        "llm_latency": args.llm_latency_ms / 1000,
+        "llm_token_latency": args.llm_token_ms / 1000,
+        "tts_latency": args.tts_latency_ms / 1000,
+        "transcript": "Me puedes decir la temperatura exterior de la casa?",
+        "answer": ("La temperatura exterior de la casa es de 21 grados. "
+                   "Es un buen momento para salir a pasear. ¿Necesitas algo más?"),
+    }
+    server = start_fake_services(config)
+    mcp_port = free_port()
+    start_fake_mcp(mcp_port, args.mcp_latency_ms / 1000)
+    time.sleep(1)  # MCP server startup
+
+    # The modules read their configuration when they are imported
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    os.environ.update({
+        "STT_URL": f"{base_url}/stt",
+        "STT_APIKEY": "bench",
+        "LLM_BASE_URL": f"{base_url}/v1",
+        "LLM_API_KEY": "bench",
+        "MCP_URL": f"http://127.0.0.1:{mcp_port}/sse",
+        "MCP_TOOLS_REFRESH_SECONDS": "0",
+        "TTS_CACHE_MAX_MB": "0" if args.no_tts_cache else os.getenv("TTS_CACHE_MAX_MB", "200"),
+        "ANSWER_CACHE": "true" if args.answer_cache else "false",
+    })
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        if not args.no_tts_cache:
+            os.environ["TTS_CACHE_DIR"] = os.path.join(output_dir, "tts_cache")
+        # The answer cache only answers the first question of a call
+        return asyncio.run(run_turns(args.turns, args.concurrency, output_dir, new_calls=args.answer_cache))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ServantPhone benchmark suite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    corpus = subparsers.add_parser("corpus", help="Generate a synthetic WAV corpus")
+    corpus.add_argument("--output", default="bench_corpus")
+    corpus.add_argument("--utterances", type=int, default=20)
+    corpus.add_argument("--seed", type=int, default=0)
+    corpus.add_argument("--labelled", action="store_true", help="Labelled corpus of the vad benchmark")
+    corpus.add_argument("--clips", type=int, default=20, help="Clips per label of the labelled corpus")
+
+    vad = subparsers.add_parser("vad", help="False triggers of the endpointer on a labelled corpus")
+    vad.add_argument("--clips", type=int, default=50, help="Clips per label")
+    vad.add_argument("--seed", type=int, default=0)
+
+    micro = subparsers.add_parser("micro", help="Audio processing micro-benchmarks")
+    micro.add_argument("--repeat", type=int, default=200)
+
+    e2e = subparsers.add_parser("e2e", help="End-to-end turns against local stand-ins")
+    e2e.add_argument("--turns", type=int, default=20)
+    e2e.add_argument("--concurrency", type=int, default=4)
+    e2e.add_argument("--stt-latency-ms", type=float, default=200)
+    e2e.add_argument("--llm-latency-ms", type=float, default=300)
+    e2e.add_argument("--llm-token-ms", type=float, default=10)
+    e2e.add_argument("--tts-latency-ms", type=float, default=200)
+    e2e.add_argument("--mcp-latency-ms", type=float, default=50)
+    e2e.add_argument("--no-tts-cache", action="store_true", help="Synthesize every sentence")
+    e2e.add_argument("--answer-cache", action="store_true",
+                     help="Answer the repeated question from the answer cache (filled by the warm-up turn)")
+
+    pool = subparsers.add_parser("pool", help="VAD analysis throughput of the audio worker pool")
+    pool.add_argument("--calls", type=int, default=64)
+    pool.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    pool.add_argument("--frames", type=int, default=1, help="Frames analyzed per poll")
+    pool.add_argument("--poll-ms", type=float, default=20, help="Interval between the polls of a call")
+    pool.add_argument("--polls", type=int, default=100, help="Polls per call")
+
+    stt = subparsers.add_parser("stt", help="STT scheduler throughput with a fake backend")
+    stt.add_argument("--utterances", type=int, default=200)
+    stt.add_argument("--latency-ms", type=float, default=300)
+    stt.add_argument("--batch-size", type=int, default=8)
+    stt.add_argument("--batch-wait-ms", type=float, default=0)
+    stt.add_argument("--concurrency", type=int, default=4)
+
+    for subparser in (micro, vad, pool, stt, e2e):
+        subparser.add_argument("--json", help="Write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    if args.command == "corpus":
+        if args.labelled:
+            count = write_labelled_corpus(args.output, args.clips, seed=args.seed)
+            print(f"{count} labelled clips generated in {args.output}")
+            return
+        files = generate_corpus(args.output, args.utterances, seed=args.seed)
+        print(f"{len(files)} utterances generated in {args.output}")
+        return
+
+    if args.command == "vad":
+        results = run_vad(args)
+        print_vad_results(results)
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump(results, json_file, indent=2)
+        return
+
+    if args.command == "micro":
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            results = run_micro(args.repeat, corpus_dir)
+    elif args.command == "pool":
+        results = asyncio.run(run_pool(args))
+        for result in results:
+            print(f"{result['name']}: main process CPU {result['main_cpu_s']:.3f} s")
+    elif args.command == "stt":
+        results = asyncio.run(run_stt(args))
+    else:
+        results = run_e2e(args)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
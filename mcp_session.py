@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import json
+import os
+import time
+from typing import List
+
+import anyio
+from langchain_core.tools import BaseTool, StructuredTool, ToolException
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from mcp.types import TextContent
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MCP_URL = os.getenv('MCP_URL')
+# Interval to refresh the tool catalogue in background. 0 disables the refresh
+MCP_TOOLS_REFRESH_SECONDS = float(os.getenv('MCP_TOOLS_REFRESH_SECONDS', '300'))
+# Opt-in cache of tool results, as a list of tool=ttl_seconds (e.g. "get_temperature=60,read_calendar=300")
+MCP_TOOL_CACHE_TTLS = os.getenv('MCP_TOOL_CACHE_TTLS', '')
+# Errors raised when the request cannot be written to a closed session, i.e. before it is sent
+NOT_SENT_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError)
+
+
+def parse_ttls(ttls: str) -> dict:
+    """
+    Parse a "name=seconds,name=seconds" list into a dictionary.
+    """
+    result = {}
+    for item in ttls.split(','):
+        if '=' not in item:
+            continue
+        name, seconds = item.split('=', 1)
+        result[name.strip()] = float(seconds)
+    return result
+
+
+class MCPSession:
+    """
+    Persistent session with the MCP server.
+
+    A single MCP session is kept open and shared by every tool call, instead of
+    opening a new SSE connection for each call. When the connection is lost, the
+    session is reopened and the call is retried once: always for the read-only tools,
+    and for the rest only if the request was not sent, so an action is not done twice.
+
+    The tool catalogue is cached and can be refreshed in background. The results of
+    the tools listed in tool_ttls are cached for the given number of seconds.
+    """
+
+    def __init__(self, url: str = MCP_URL, server_name: str = "servant", tool_ttls: dict = None):
+        self.server_name = server_name
+        self.client = MultiServerMCPClient(
+            {
+                server_name: {
+                    "url": url,
+                    "transport": "sse",
+                }
+            }
+        )
+        self.tool_ttls = tool_ttls if tool_ttls is not None else parse_ttls(MCP_TOOL_CACHE_TTLS)
+        self.tools_catalogue = []
+        self.on_tools_changed = None
+        self.on_tool_data_changed = None
+        self.session = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._session_task = None
+        self._stop = None
+        self._refresh_task = None
+        self._results = {}
+        self._digests = {}
+
+    async def _run_session(self, ready: asyncio.Future):
+        """
+        The session lives in its own task: the SSE client must be opened and closed
+        from the same task.
+        """
+        try:
+            async with self.client.session(self.server_name) as session:
+                self.session = session
+                ready.set_result(session)
+                await self._stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(f"MCP session closed: {e}")
+        finally:
+            self.session = None
+
+    async def connect(self, generation: int = None):
+        """
+        Open (or reopen) the MCP session. When generation is given, the session is
+        only reopened if it has not been reopened since that generation: several
+        calls can fail at the same time, but only the first one reconnects.
+        """
+        async with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            await self._disconnect()
+            self._stop = asyncio.Event()
+            ready = asyncio.get_running_loop().create_future()
+            self._session_task = asyncio.create_task(self._run_session(ready))
+            await ready
+            self._generation += 1
+            logger.info(f"MCP session connected to {self.server_name}")
+
+    async def _disconnect(self):
+        if self._session_task:
+            self._stop.set()
+            await asyncio.gather(self._session_task, return_exceptions=True)
+            self._session_task = None
+
+    async def _ensure_session(self):
+        if self.session is None:
+            await self.connect(self._generation)
+        return self.session, self._generation
+
+    async def list_tools(self, refresh: bool = False) -> list:
+        """
+        Catalogue of MCP tools, fetched only once unless refresh is requested.
+        """
+        if self.tools_catalogue and not refresh:
+            return self.tools_catalogue
+
+        session, generation = await self._ensure_session()
+        try:
+            tools = await self._list_all_tools(session)
+        except Exception as e:
+            logger.warning(f"Error listing MCP tools, reconnecting: {e}")
+            await self.connect(generation)
+            tools = await self._list_all_tools(self.session)
+
+        self.tools_catalogue = tools
+        return tools
+
+    @staticmethod
+    async def _list_all_tools(session) -> list:
+        tools = []
+        cursor = None
+        while True:
+            page = await session.list_tools(cursor=cursor)
+            tools.extend(page.tools)
+            if page.nextCursor is None:
+                return tools
+            cursor = page.nextCursor
+
+    async def call_tool(self, name: str, arguments: dict) -> str:
+        """
+        Call a tool through the persistent session, using the result cache when
+        the tool has a TTL.
+        """
+        ttl = self.tool_ttls.get(name)
+        cache_key = (name, json.dumps(arguments, sort_keys=True, default=str))
+        if ttl:
+            cached = self._results.get(cache_key)
+            if cached and cached[0] > time.monotonic():
+                logger.debug(f"MCP tool {name}: cached result")
+                return cached[1]
+
+        session, generation = await self._ensure_session()
+        try:
+            result = await session.call_tool(name, arguments)
+        except Exception as e:
+            logger.warning(f"Error calling MCP tool {name}, reconnecting: {e}")
+            await self.connect(generation)
+            # A tool with side effects is only retried if the request could not be sent
+            # (e.g. after a timeout, the action may have been done already)
+            if not self.read_only(name) and not isinstance(e, NOT_SENT_ERRORS):
+                raise
+            result = await self.session.call_tool(name, arguments)
+
+        content = "\n".join(item.text for item in result.content if isinstance(item, TextContent))
+        if result.isError:
+            raise ToolException(content)
+
+        if ttl:
+            now = time.monotonic()
+            # The expired results are removed, so the cache does not grow with every set of arguments
+            for key in [key for key, (expires, _) in self._results.items() if expires <= now]:
+                del self._results[key]
+            self._results[cache_key] = (now + ttl, content)
+        self._check_data_changed(name, cache_key, content)
+        return content
+
+    def read_only(self, name: str) -> bool:
+        """
+        Whether a tool has no side effects: the server declares it as read-only
+        (readOnlyHint) or its results are cached (see tool_ttls).
+        """
+        if name in self.tool_ttls:
+            return True
+        for tool in self.tools_catalogue:
+            if tool.name == name:
+                return bool(tool.annotations and tool.annotations.readOnlyHint)
+        return False
+
+    def _check_data_changed(self, name: str, cache_key: tuple, content: str):
+        if not self.read_only(name):
+            changed = None
+        else:
+            digest = hash(content)
+            previous = self._digests.get(cache_key)
+            self._digests[cache_key] = digest
+            if previous is None or previous == digest:
+                return
+            changed = name
+
+        logger.debug(f"MCP tool data changed ({name})")
+        if self.on_tool_data_changed:
+            self.on_tool_data_changed(changed)
+
+    def langchain_tools(self) -> List[BaseTool]:
+        """
+        LangChain tools for the current catalogue. Every call goes through call_tool.
+        """
+        def make_tool(tool):
+            async def call(**arguments):
+                return await self.call_tool(tool.name, arguments)
+
+            return StructuredTool(
+                name=tool.name,
+                description=tool.description or "",
+                args_schema=tool.inputSchema,
+                coroutine=call,
+            )
+
+        return [make_tool(tool) for tool in self.tools_catalogue]
+
+    def start_refresh(self, interval: float = MCP_TOOLS_REFRESH_SECONDS):
+        """
+        Refresh the tool catalogue periodically in background. When it changes,
+        on_tools_changed is called with the new LangChain tools.
+        """
+        if interval <= 0 or self._refresh_task:
+            return
+        self._refresh_task = asyncio.create_task(self._refresh_loop(interval))
+
+    async def _refresh_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                previous = [tool.model_dump() for tool in self.tools_catalogue]
+                await self.list_tools(refresh=True)
+                if [tool.model_dump() for tool in self.tools_catalogue] != previous:
+                    logger.info("MCP tool catalogue changed")
+                    if self.on_tools_changed:
+                        self.on_tools_changed(self.langchain_tools())
+            except Exception as e:
+                logger.warning(f"Error refreshing the MCP tool catalogue: {e}")
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+        async with self._lock:
+            await self._disconnect()
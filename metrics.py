@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Optional file where every turn is appended as a JSON line
+METRICS_JSONL = os.getenv('METRICS_JSONL')
+# Optional port of the Prometheus metrics endpoint (/metrics). 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+DEFAULT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    """
+    Configure the log level of the application (DEBUG, INFO, WARNING, ERROR).
+    """
+    logging.basicConfig(level=getattr(logging, level.upper(), logging.INFO),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations, in seconds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[int]:
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class MetricsRegistry:
+    """
+    Aggregation of the turn timings: one histogram per step of the turn.
+    The turns can be exported as JSON lines and the histograms through a
+    Prometheus-style text endpoint.
+    """
+
+    NAME = "servantphone_turn_step_seconds"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, jsonl_path: str = METRICS_JSONL):
+        self.buckets = buckets
+        self.jsonl_path = jsonl_path
+        self.histograms = {}
+        self.turns = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def observe(self, step: str, seconds: float):
+        with self._lock:
+            if step not in self.histograms:
+                self.histograms[step] = Histogram(self.buckets)
+            self.histograms[step].observe(seconds)
+
+    def export_turn(self, record: dict):
+        """
+        Aggregate the spans of a finished turn and append it to the JSONL file.
+        """
+        for span in record["spans"]:
+            self.observe(span["step"], span["seconds"])
+        for name, seconds in record["marks"].items():
+            self.observe(name, seconds)
+
+        with self._lock:
+            self.turns += 1
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a', encoding='utf-8') as jsonl_file:
+                    jsonl_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP servantphone_turns_total Number of finished conversation turns",
+            "# TYPE servantphone_turns_total counter",
+            f"servantphone_turns_total {self.turns}",
+            f"# HELP {self.NAME} Duration of each step of a conversation turn",
+            f"# TYPE {self.NAME} histogram",
+        ]
+        with self._lock:
+            for step, histogram in sorted(self.histograms.items()):
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    lines.append(f'{self.NAME}_bucket{{step="{step}",le="{bound}"}} {count}')
+                lines.append(f'{self.NAME}_sum{{step="{step}"}} {histogram.sum:.6f}')
+                lines.append(f'{self.NAME}_count{{step="{step}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = METRICS_PORT):
+        """
+        Start the HTTP endpoint (GET /metrics) in a background thread.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics endpoint listening on port {self._server.server_port}")
+
+
+metrics = MetricsRegistry()
+
+
+class TurnMetrics:
+    """
+    Timing of one conversation turn: spans (duration of each step: STT, LLM, tools,
+    TTS...) and marks (time since the start of the turn, e.g. when the playback starts).
+
+    The turn is exported once every expected part is complete. For example, the call
+    waits for both the processing of the turn and the start of the playback.
+    """
+
+    def __init__(self, session_id: str = None, parts=("processing",), registry: MetricsRegistry = None):
+        self.session_id = session_id
+        self.registry = registry or metrics
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.spans = []
+        self.marks = {}
+        self._pending = set(parts)
+        self._lock = threading.Lock()
+
+    def add(self, step: str, seconds: float):
+        with self._lock:
+            self.spans.append({"step": step, "seconds": round(seconds, 6)})
+
+    @contextmanager
+    def span(self, step: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(step, time.monotonic() - start)
+
+    def mark(self, name: str):
+        """
+        Record the time since the start of the turn, only the first time.
+        """
+        with self._lock:
+            if name not in self.marks:
+                self.marks[name] = round(time.monotonic() - self.start, 6)
+
+    def complete(self, part: str):
+        with self._lock:
+            if part not in self._pending:
+                return
+            self._pending.discard(part)
+            if self._pending:
+                return
+            record = {
+                "session_id": self.session_id,
+                "timestamp": self.started_at,
+                "total": round(time.monotonic() - self.start, 6),
+                "spans": list(self.spans),
+                "marks": dict(self.marks),
+            }
+
+        record["spans"].append({"step": "turn", "seconds": record["total"]})
+        logger.info(f"Turn finished in {record['total']:.3f}s: {record['spans']} {record['marks']}")
+        self.registry.export_turn(record)
@@ -1,16 +1,31 @@
+import collections
+import importlib
+import itertools
+import logging
 import os
+import sys
 import threading
-import pjsua2 as pj
 import time
-from audio_processor import VAD, concat_wav_files, process_audio 
+import pjsua2 as pj
+import numpy as np
+from audio_codecs import Resampler
+from audio_processor import (AUDIO_CLOCK_RATE, VAD, Endpointer, EndpointEvent, PCMRingBuffer, UtteranceBuffer,
+                             process_audio, prewarm_tts, transcribe)
 import queue
 import asyncio
-from agent import MCPAgent
+from stt import STT_STREAMING, STTStream, get_stt_backend, get_stt_scheduler
+from tts_cache import TTS_PREWARM_FILE, read_phrases
+from metrics import METRICS_PORT, TurnMetrics, configure_logging, metrics
+from storage import CallStorage, sweep
+from prompts import get_prompt_cache, prompt_files
+from audio_workers import get_audio_pool
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 STUN_PROXY = os.getenv('STUN_PROXY')
 SIP_ID = os.getenv('SID_ID')
 SID_REGISTRAR = os.getenv('SID_REGISTRAR')
@@ -19,60 +34,324 @@ SIP_PROXY = os.getenv('SID_PROXY')
 AUTH_DOMAIN = os.getenv('AUTH_DOMAIN')
 AUTH_USERNAME = os.getenv('AUTH_USERNAME')
 AUTH_PASSWORD = os.getenv('AUTH_PASSWORD')
+PJSIP_LOG_LEVEL = int(os.getenv('PJSIP_LOG_LEVEL', '5'))
+# Maximum time to wait for the SIP registration at startup
+REGISTRATION_TIMEOUT = float(os.getenv('REGISTRATION_TIMEOUT', '10'))
+
+AGENT_ROLE = "Tú eres un asistente. Utiliza las tools si piensas que te pueden dar información util, si no utiliza tu conocimiento interno. Contesta siempre en español"
+
+# Audio is captured in 20ms frames
+FRAME_TIME_USEC = 20000
+POLL_INTERVAL = 0.02
+
+# Maximum number of simultaneous calls (inbound and outbound)
+MAX_CALLS = int(os.getenv('MAX_CALLS', '4'))
+# Answer the incoming calls, instead of only placing outbound calls
+INCOMING_CALLS = os.getenv('INCOMING_CALLS', 'false').lower() in ('1', 'true', 'yes')
+
+_call_counter = itertools.count(1)
+# Safeguard in case the end of file of a player is never notified
+MAX_PLAYBACK_SECONDS = 120
+# Barge-in: continuous speech (ms) of the user that interrupts the answer. 0 disables it
+BARGE_IN_MS = int(os.getenv('BARGE_IN_MS', '200'))
+# Speculative turns: the transcription starts on a provisional pause of the user (ENDPOINT_PAUSE_MS)
+SPECULATIVE_TURNS = os.getenv('SPECULATIVE_TURNS', 'false').lower() in ('1', 'true', 'yes')
+# The answer of the agent is also generated (and synthesized) before the end of the turn is confirmed
+SPECULATIVE_LLM = os.getenv('SPECULATIVE_LLM', 'false').lower() in ('1', 'true', 'yes')
+
+
+class Player(pj.AudioMediaPlayer):
+    """
+    Audio file player notifying the end of the playback.
+    """
+
+    def __init__(self):
+        pj.AudioMediaPlayer.__init__(self)
+        self.finished = threading.Event()
+
+    def onEof2(self):
+        # Called from the PJMEDIA media thread
+        self.finished.set()
+
+
+class MemoryPlayer(pj.AudioMediaPort):
+    """
+    Media port playing in-memory PCM clips (see PromptCache). The port is connected to
+    the call once and reused for every clip: PJMEDIA requests every frame through
+    onFrameRequested, so a clip starts with no file open or decode step.
+    Silence is sent while no clip is being played.
+    """
+
+    def __init__(self):
+        pj.AudioMediaPort.__init__(self)
+        self.finished = threading.Event()
+        self.frame_len_samples = 0
+        self._clip = None
+        self._position = 0
+        self._lock = threading.Lock()
+
+    def create(self, sample_rate: int):
+        self.frame_len_samples = sample_rate * FRAME_TIME_USEC // 1000000
+        fmt = pj.MediaFormatAudio()
+        fmt.init(pj.PJMEDIA_FORMAT_PCM, sample_rate, 1, FRAME_TIME_USEC, 16)
+        self.createPort("prompts", fmt)
+
+    def play(self, clip: np.ndarray):
+        with self._lock:
+            self._clip = clip
+            self._position = 0
+            self.finished.clear()
+
+    def stop(self):
+        with self._lock:
+            self._clip = None
+            self.finished.set()
+
+    def onFrameRequested(self, frame):
+        # Called from the PJMEDIA media thread
+        samples = np.zeros(self.frame_len_samples, dtype=np.int16)
+        with self._lock:
+            if self._clip is not None:
+                chunk = self._clip[self._position:self._position + self.frame_len_samples]
+                samples[:chunk.size] = chunk
+                self._position += self.frame_len_samples
+                if self._position >= self._clip.size:
+                    self._clip = None
+                    self.finished.set()
+        frame.type = pj.PJMEDIA_FRAME_TYPE_AUDIO
+        frame.buf = pj.ByteVector(samples.tobytes())
+        frame.size = samples.nbytes
+
+
+class CapturePort(pj.AudioMediaPort):
+    """
+    Custom media port connected to the call audio. PJMEDIA delivers every captured
+    frame through onFrameReceived, which is pushed into an in-memory ring buffer.
+    This avoids recording audio segments into WAV files.
+    """
+
+    def __init__(self, frames: PCMRingBuffer):
+        pj.AudioMediaPort.__init__(self)
+        self.frames = frames
+
+    def create(self, sample_rate: int):
+        fmt = pj.MediaFormatAudio()
+        fmt.init(pj.PJMEDIA_FORMAT_PCM, sample_rate, 1, FRAME_TIME_USEC, 16)
+        self.createPort("capture", fmt)
+
+    def onFrameReceived(self, frame):
+        # Called from the PJMEDIA media thread
+        if frame.type == pj.PJMEDIA_FRAME_TYPE_AUDIO:
+            self.frames.push(bytes(frame.buf))
+
+
+class SpeculativeTurn:
+    """
+    Turn started on a provisional pause of the user, before the end of the turn is
+    confirmed by the endpointer.
+
+    The transcription of the utterance starts at once. With SPECULATIVE_LLM, the answer
+    is also generated and synthesized, but its audio is held until the turn is confirmed,
+    as are the calls to the tools with side effects (the read-only tools run at once).
+    If the user speaks again, the work is cancelled and the agent conversation is
+    rolled back to its previous checkpoint.
+    """
+
+    def __init__(self, call: 'MyCall', audio: bytes, answer: bool = False, after: list = ()):
+        self.call = call
+        self.turn = TurnMetrics(call.session_id, parts=("processing", "playback"))
+        self.confirmed = False
+        # Set on confirmation: the tools with side effects can be called
+        self.confirmation = asyncio.Event()
+        self.generation = None
+        self.held = []
+        self.checkpointed = False
+        self.checkpoint = None
+        self.transcription = asyncio.create_task(transcribe(audio))
+        self.answer = asyncio.create_task(self._answer(after)) if answer else None
+
+    async def _answer(self, after: list) -> list[str]:
+        if after:
+            # Wait for the rollback of the previous speculative turns
+            await asyncio.wait(after)
+        self.checkpoint = await self.call.agent.checkpoint(self.call.session_id)
+        self.checkpointed = True
+        try:
+            return await process_audio(self.transcription, self.call.agent, self.enqueue,
+                                       session_id=self.call.session_id,
+                                       output_dir=self.call.storage.directory, turn=self.turn,
+                                       hold_tools=self.confirmation)
+        except asyncio.CancelledError:
+            if not self.confirmed:
+                await self._rollback()
+            raise
+
+    async def _rollback(self):
+        if self.checkpointed:
+            await self.call.agent.rollback(self.call.session_id, self.checkpoint)
+
+    def enqueue(self, filename):
+        if self.confirmed:
+            self.call.play(filename, self.turn, self.generation)
+        else:
+            self.held.append(filename)
+
+    def confirm(self):
+        """
+        The end of the turn is confirmed: the audio of the answer can be played.
+        """
+        self.turn.mark("end_of_turn")
+        self.confirmed = True
+        self.confirmation.set()
+        self.generation = self.call.playback_generation
+        for filename in self.held:
+            self.call.play(filename, self.turn, self.generation)
+        self.held.clear()
+
+    def cancel(self) -> asyncio.Task:
+        """
+        Discard the speculative work. Returns the task rolling back the conversation,
+        if the answer was started.
+        """
+        self.confirmed = False
+        self.transcription.cancel()
+        for filename in self.held:
+            self.call.storage.release(filename)
+        self.held.clear()
+
+        if not self.answer:
+            return None
+        if self.answer.done():
+            # The answer was already complete: its messages are removed from the conversation
+            return asyncio.create_task(self._rollback())
+        self.answer.cancel()
+        return self.answer
 
 
 class MyCall(pj.Call):
     """
     MyCall class handles the call media and recording.
+
+    Every call has its own session id, used as the name of its audio directory and
+    as the agent conversation thread, so several calls can run at the same time.
     """
 
-    def __init__(self, acc, ep_instance: pj.Endpoint, agent):
-        pj.Call.__init__(self, acc)
+    def __init__(self, acc, ep_instance: pj.Endpoint, agent, call_id=pj.PJSUA_INVALID_ID):
+        pj.Call.__init__(self, acc, call_id)
         self.ep = ep_instance # Store the Endpoint instance
-        self.recorder = None
+        self.session_id = f"{time.strftime('%Y%m%d%H%M%S')}_{next(_call_counter)}"
+        self.storage = CallStorage(self.session_id)
+        self.capture_port = None
         self.aud_med = None
-        self.segment_index = 0
-        self.vad = VAD(energy_threshold=0.0002, zcr_threshold=0.04)
-        self.pre_silence_detected = True
-        self.last_segment_index = 0
+        self.vad = VAD(energy_threshold=0.0002)
+        self.endpointer = Endpointer(self.vad)
+        # The call audio is captured at the clock rate and converted to the VAD rate in the polling loop
+        self.frames = PCMRingBuffer(AUDIO_CLOCK_RATE * FRAME_TIME_USEC // 1000000)
+        self.capture_resampler = Resampler(AUDIO_CLOCK_RATE, self.vad.sample_rate)
+        self.capture_rest = np.zeros(0, dtype=np.int16)
+        # With AUDIO_WORKERS, the frames are analyzed by the worker processes
+        self.audio_pool = get_audio_pool()
+        self.shared_frames = (self.audio_pool.shared_frames(self.vad.frame_len_samples, self.vad.sample_rate)
+                              if self.audio_pool else None)
+        self.pre_roll = collections.deque(maxlen=self.endpointer.pre_roll_frames + self.endpointer.onset_frames)
+        self.speaking = False
+        self.utterance = UtteranceBuffer(self.vad.sample_rate)
+        self.stt_stream = None
+        self.stt_pushed = 0
+        self.speculation = None
+        self.discarded = []
         self.to_reproduce = queue.Queue()
-        self.players = []
+        self.player = None
+        self.prompt_port = None
+        self.playback_generation = 0
+        self.playing = threading.Event()
+        # Set while the audio of an answer (not a prompt like the acknowledgment tone) is played
+        self.playing_answer = threading.Event()
+        self.speech_frames = 0
         self.agent = agent
+        self.turns = asyncio.Queue()
+        self.turn_worker = None
+        self.current_turn = None
 
     def onCallState(self, prm):
         call_info = self.getInfo()
-        print(f"Call state: {call_info.stateText}, last reason: {call_info.lastReason}")
+        logger.info(f"Call state: {call_info.stateText}, last reason: {call_info.lastReason}")
 
     def onCallMediaState(self, prm):
         ci = self.getInfo()
-        print("*****************onCallMediaState")
-        print(ci.state)
+        logger.debug("*****************onCallMediaState")
         for mi in ci.media:
-            print("type")
-            print(mi.type)
-            print(mi.index)
             if mi.type == 1 and ci.state == 4:
                 self.aud_med = pj.AudioMedia.typecastFromMedia(self.getMedia(mi.index))
-                self.start_new_segment()
+                self.log_codec(mi.index)
+                self.start_capture()
+                self.start_prompts()
 
                 self.start_backloop()
 
+    def log_codec(self, index: int):
+        """
+        Log the negotiated codec. PJMEDIA resamples the call audio when the codec rate
+        differs from the clock rate (AUDIO_CLOCK_RATE).
+        """
+        try:
+            info = self.getStreamInfo(index)
+        except pj.Error as e:
+            logger.debug(f"No stream info: {e.info()}")
+            return
+        logger.info(f"Codec: {info.codecName}/{info.codecClockRate}")
+        if info.codecClockRate != AUDIO_CLOCK_RATE:
+            logger.info(f"The codec rate differs from AUDIO_CLOCK_RATE={AUDIO_CLOCK_RATE}: "
+                        f"the call audio is resampled by PJMEDIA")
+
     def _worker(self):
         """
         Audio playback worker thread. This thread will continuously check the queue to_reproduce
         for audio files to play and manage the playback state.
+
+        Every item is tagged with the playback generation it was queued for. After a
+        barge-in the generation changes: the current audio is stopped and the items of
+        the previous generation are skipped.
         """
 
         # --- PJLIB THREAD REGISTRATION ---
         self.ep.libRegisterThread("MyCallPlaybackWorker")
-        print("Playback worker registered with PJLIB.")
+        logger.debug("Playback worker registered with PJLIB.")
         # --- END REGISTRATION ---
 
-        print("worker started...")
+        logger.debug("worker started...")
         while True:
             item = self.to_reproduce.get()
-            print("item", item)
-            self.playFile(item)
+            if item is None:
+                # The call is finished
+                break
+            filename, turn, generation = item
+            logger.debug(f"item {filename}")
+            if generation != self.playback_generation:
+                self.storage.release(filename)
+                self.to_reproduce.task_done()
+                continue
+            try:
+                clip = get_prompt_cache().get(filename)
+                player = self.playClip(clip) if clip is not None else self.playFile(filename)
+                self.playing.set()
+                if turn:
+                    self.playing_answer.set()
+                    turn.mark("playback_start")
+                    turn.complete("playback")
+                # Wait for the end of the audio before playing the next item
+                if generation == self.playback_generation:
+                    player.finished.wait(MAX_PLAYBACK_SECONDS)
+                if generation != self.playback_generation:
+                    # Barge-in: the user has interrupted this audio
+                    self.stop_playback()
+            except Exception as e:
+                logger.error(f"Error playing {filename}: {e}")
+            finally:
+                self.playing_answer.clear()
+                if self.to_reproduce.empty():
+                    self.playing.clear()
+                self.storage.release(filename)
             self.to_reproduce.task_done()
 
 
@@ -84,154 +363,564 @@ class MyCall(pj.Call):
 
     
     def playFile(self, filename):
-        print("playing ", filename)
+        logger.debug(f"playing {filename}")
 
-        new_player = pj.AudioMediaPlayer()
+        new_player = Player()
         new_player.createPlayer(filename, pj.PJMEDIA_FILE_NO_LOOP)
 
-        if len(self.players) > 0:
-            curr_player = self.players.pop()
-            curr_player.stopTransmit(self.aud_med)
-
+        self.stop_playback()
         new_player.startTransmit(self.aud_med)
-        self.players.append(new_player)
+        self.player = new_player
+        return new_player
 
 
-    def start_new_segment(self):
+    def playClip(self, clip):
         """
-        Start a new audio segment for recording. 
+        Play an in-memory clip (see PromptCache) through the prompt port of the call.
         """
-        if self.recorder:
-            self.recorder = None  # Close previous
-        file_name = f"chat_files/segment_{self.segment_index}.wav"
-        self.recorder = pj.AudioMediaRecorder()
-        self.recorder.createRecorder(file_name)
-        self.aud_med.startTransmit(self.recorder)
-        print(f"Started recording {file_name}")
-        self.segment_index += 1
-    
+        logger.debug(f"playing a clip of {clip.size} samples")
+        self.stop_playback()
+        self.prompt_port.play(clip)
+        self.player = self.prompt_port
+        return self.prompt_port
 
-    async def check_audio_level(self):
+
+    def stop_playback(self):
         """
-        Check the audio level and manage silence detection.
+        Stop the audio being played. Must be called from the playback worker thread.
         """
-        if not self.aud_med:
-            return
+        player, self.player = self.player, None
+        if isinstance(player, Player):
+            player.stopTransmit(self.aud_med)
+        elif player:
+            player.stop()
 
-        # Generates a new audio segment
-        self.start_new_segment()
 
-        # check the last (and previous) audio files
-        await self.check_incomming_audio(self.segment_index - 2)
-                
+    def play(self, filename, turn=None, generation=None):
+        """
+        Queue an audio file to be played after the current one.
+        """
+        if generation is None:
+            generation = self.playback_generation
+        self.to_reproduce.put((filename, turn, generation))
+
 
-    async def check_incomming_audio(self, current_segment_index):
+    def is_answering(self) -> bool:
+        """
+        Whether the audio of an answer is being played (or queued) to the user.
+        While the answer is still being processed, the user is not interrupting it:
+        the new speech is a continuation after a pause and is queued as a new turn.
         """
-        Check the incoming audio for silence detection.
-        If silence is detected and the previous segment was speech,
-        process the audio segment and generate a response.
+        if self.playing_answer.is_set():
+            return True
+        with self.to_reproduce.mutex:
+            return any(item is not None and item[1] is not None and item[2] == self.playback_generation
+                       for item in self.to_reproduce.queue)
+
 
-        There are two variables to handle the current status:
-        - pre_silence_detected: Indicates if the previous segment was silent
-        - last_segment_index: Keeps track of the last silent segment. This element is required to join audio segments correctly.
+    def barge_in(self):
         """
-        print("check_incoming_message...")
-        silence_detected = self.evaluate_energy(current_segment_index, current_segment_index - self.last_segment_index)
-        print("silence detected", silence_detected)
+        The user speaks while the answer is being played: the playback is stopped, the
+        queued audio is dropped and the turns in progress are cancelled (STT, agent and
+        TTS), so nothing is spent on audio nobody hears.
+        """
+        logger.info("Barge-in: the user interrupts the answer")
+        self.playback_generation += 1
+        player = self.player
+        if player:
+            player.finished.set()
+
+        while True:
+            try:
+                item = self.to_reproduce.get_nowait()
+            except queue.Empty:
+                break
+            self.to_reproduce.task_done()
+            if item is None:
+                # Keep the stop signal of the worker
+                self.to_reproduce.put(None)
+                break
+            self.storage.release(item[0])
 
-        if silence_detected and not self.pre_silence_detected:
-            print("found pause...", silence_detected, self.pre_silence_detected)
-            self.to_reproduce.put("Ring04.wav")
-            audio_file = self.join_audio(self.last_segment_index, current_segment_index)
-            self.last_segment_index = current_segment_index
-            response_file = await process_audio(audio_file, self.agent)
-            self.to_reproduce.put(response_file)
-        elif not silence_detected and self.pre_silence_detected:
-            self.last_segment_index = current_segment_index
+        self.drop_queued_turns("barge_in")
 
-        # Update the previous silence detection state
-        self.pre_silence_detected = silence_detected
+        if self.current_turn:
+            self.current_turn.cancel()
+
+
+    def drop_queued_turns(self, reason: str):
+        """
+        Drop the turns waiting to be processed, stopping their transcriptions (and answers).
+        """
+        while not self.turns.empty():
+            job, turn = self.turns.get_nowait()
+            self.turns.task_done()
+            if isinstance(job, SpeculativeTurn):
+                rollback = job.cancel()
+                if rollback:
+                    self.discarded.append(rollback)
+            elif isinstance(job, STTStream):
+                # Otherwise the upload waits for more audio forever, holding its connection
+                job.cancel()
+            turn.mark(reason)
+            turn.complete("processing")
+            turn.complete("playback")
+
+
+    def start_capture(self):
+        """
+        Connect the call audio to the in-memory capture port.
+        """
+        if self.capture_port:
+            return
+        self.capture_port = CapturePort(self.frames)
+        self.capture_port.create(AUDIO_CLOCK_RATE)
+        self.aud_med.startTransmit(self.capture_port)
+        logger.info("Started audio capture")
 
 
-    def join_audio(self, min_segment, max_segment):
+    def start_prompts(self):
         """
-        Auxiliary function to join audio segments. This method is used to concatenate
-        multiple audio files into a single file.
-        Then this new file can be used to process the audio data, for example for transcription.
+        Connect the prompt port (in-memory clips) to the call audio.
         """
+        if self.prompt_port:
+            return
+        self.prompt_port = MemoryPlayer()
+        self.prompt_port.create(get_prompt_cache().sample_rate)
+        self.prompt_port.startTransmit(self.aud_med)
 
-        inputfiles = [f"chat_files/segment_{i}.wav"  for i in range(min_segment, max_segment)]
-        outputfile = f"chat_files/concat_{min_segment}_{max_segment}.wav"
 
-        concat_wav_files(inputfiles, outputfile)
+    def captured_frames(self) -> np.ndarray:
+        """
+        Pending captured frames, converted to the VAD sample rate.
+        """
+        frames = self.frames.pop_all()
+        if AUDIO_CLOCK_RATE == self.vad.sample_rate:
+            return frames
 
-        return outputfile
+        pcm = np.concatenate((self.capture_rest, self.capture_resampler.process(frames)))
+        size = pcm.size // self.vad.frame_len_samples * self.vad.frame_len_samples
+        self.capture_rest = pcm[size:]
+        return pcm[:size].reshape(-1, self.vad.frame_len_samples)
 
-    
-    def evaluate_energy(self, current_segment_index, distance):
-        if current_segment_index < 0:
-            return True
 
-        # Give some time to ensure the file is written and is available
-        time.sleep(0.1)
-        
-        file_name = f"chat_files/segment_{current_segment_index}.wav"
-        print("evaluate_energy ", file_name)
-
-        if not os.path.exists(file_name):
-            raise FileNotFoundError(f"File not found: {file_name}")
-
-        speech_results = self.vad.is_speech(file_name)
-        self.vad.reset()
-
-        # count speech and silence frames
-        speech_counter = 0
-        silence_counter = 0
-        for i, is_speech_frame in enumerate(speech_results):
-            #print(f"{i}->{is_speech_frame}")
-            
-            if is_speech_frame:
-                speech_counter += 1
+    async def check_audio_level(self):
+        """
+        Check the audio level and detect the end of the user turns.
+        Every captured frame is analyzed by the endpointer as soon as it is available.
+        While the user speaks, the frames are appended to the current utterance; in
+        silence, only the last frames are kept as the pre-roll of the next utterance.
+        """
+        if not self.aud_med:
+            return
+
+        frames = self.captured_frames()
+        if self.shared_frames:
+            # The features of the frames of the previous poll, analyzed by the worker meanwhile
+            frames, features = self.shared_frames.exchange(frames)
+        else:
+            features = self.vad.frame_features(frames)
+        # The echo of our own audio is suppressed while it is played
+        self.endpointer.playing = self.playing.is_set()
+        speech_frames, events = self.endpointer.process_features(*features)
+        events = {event.index: event.type for event in events}
+
+        barge_in_frames = BARGE_IN_MS // self.vad.frame_len_ms
+        for index, (frame, is_speech_frame) in enumerate(zip(frames, speech_frames)):
+            self.speech_frames = self.speech_frames + 1 if is_speech_frame else 0
+
+            if barge_in_frames and self.speech_frames == barge_in_frames and self.is_answering():
+                self.barge_in()
+
+            if self.speaking:
+                self.utterance.append(frame)
             else:
-                silence_counter += 1
+                self.pre_roll.append(frame)
+
+            event = events.get(index)
+            if event == EndpointEvent.START:
+                self.on_speech_start()
+            elif event == EndpointEvent.PAUSE:
+                self.on_speech_pause()
+            elif event == EndpointEvent.RESUME:
+                self.cancel_speculation()
+            elif event == EndpointEvent.END:
+                self.on_speech_end()
 
-        print(f"{silence_counter}||{speech_counter}")
+        self.push_stt()
 
-        # Calculate the silence ratio to determine if the segment is silent
-        # Silence ratio is defined as the proportion of silence frames to total frames
-        return (silence_counter / (speech_counter + silence_counter)) > 0.95
+
+    def on_speech_start(self):
+        """
+        The user starts speaking: a new utterance starts with the pre-roll audio, so
+        the first syllable is not clipped.
+        """
+        logger.debug("speech started...")
+        self.speaking = True
+        self.utterance = UtteranceBuffer(self.vad.sample_rate)
+        for frame in self.pre_roll:
+            self.utterance.append(frame)
+        self.pre_roll.clear()
+        if STT_STREAMING and get_stt_backend().streaming:
+            self.stt_stream = get_stt_backend().open_stream(self.vad.sample_rate)
+            self.stt_pushed = 0
+
+
+    def push_stt(self):
+        """
+        Upload the new audio of the utterance when the STT is streamed.
+        """
+        if self.stt_stream and len(self.utterance) > self.stt_pushed:
+            self.stt_stream.push(self.utterance.tail(self.stt_pushed))
+            self.stt_pushed = len(self.utterance)
+
+
+    def on_speech_pause(self):
+        """
+        Provisional pause of the user: with SPECULATIVE_TURNS, the turn starts before the
+        end of the turn is confirmed (see SpeculativeTurn). The answer is only generated
+        in advance when no other turn of the call is in progress.
+        """
+        if not SPECULATIVE_TURNS or self.stt_stream:
+            return
+        self.cancel_speculation()
+        logger.debug("provisional pause, starting a speculative turn...")
+        answer = (SPECULATIVE_LLM and self.current_turn is None and self.turns.empty()
+                  and not self.is_answering())
+        self.speculation = SpeculativeTurn(self, self.utterance.snapshot(), answer=answer, after=list(self.discarded))
+
+
+    def cancel_speculation(self):
+        """
+        The user speaks again after a provisional pause: the speculative turn is discarded.
+        """
+        if not self.speculation:
+            return
+        logger.debug("speech resumed, speculative turn cancelled")
+        rollback = self.speculation.cancel()
+        if rollback:
+            self.discarded.append(rollback)
+        self.speculation = None
+
+
+    def on_speech_end(self):
+        """
+        The user has stopped speaking (the endpointer hangover has elapsed): the
+        utterance is closed and processed in background. If a speculative turn was
+        started on the pause, its transcription (and answer) is used.
+        """
+        logger.info("found pause...")
+        self.speaking = False
+        speculation, self.speculation = self.speculation, None
+        turn = speculation.turn if speculation else TurnMetrics(self.session_id, parts=("processing", "playback"))
+        # Audio time between the last speech frame and the detection of the pause
+        turn.add("end_of_speech", self.endpointer.hangover_frames * self.vad.frame_len_ms / 1000)
+        self.play("Ring04.wav")
+        self.push_stt()
+        with turn.span("utterance_assembly"):
+            audio_file = self.join_audio()
+        self.storage.save_recording(audio_file)
+        if self.stt_stream:
+            # The audio has already been uploaded while the user was speaking
+            audio_file, self.stt_stream = self.stt_stream, None
+        if speculation:
+            # No speech after the provisional pause: the speculative turn is confirmed
+            speculation.confirm()
+            audio_file = speculation
+        # The turn is processed in background, so the audio polling is not blocked
+        self.turns.put_nowait((audio_file, turn))
+
+
+    def join_audio(self):
+        """
+        Auxiliary function to close the current utterance. The audio frames have been
+        appended to the utterance buffer while they were analyzed, so this method only
+        writes the WAV header and starts a new buffer for the next utterance.
+        The returned WAV data can be used to process the audio, for example for transcription.
+        """
+        logger.info(f"Utterance of {len(self.utterance)} bytes")
+        audio = self.utterance.wav()
+        self.utterance = UtteranceBuffer(self.vad.sample_rate)
+        return audio
+
+
+    async def _turn_worker(self):
+        """
+        Asyncio task processing the user utterances, one turn at a time.
+        Each turn (STT, agent and TTS) runs concurrently with the audio polling.
+        """
+        while True:
+            audio_file, turn = await self.turns.get()
+            if self.discarded:
+                # Wait for the rollback of the cancelled speculative turns
+                discarded, self.discarded = self.discarded, []
+                await asyncio.wait(discarded)
+            if isinstance(audio_file, SpeculativeTurn) and audio_file.answer:
+                # The answer is already being generated
+                self.current_turn = audio_file.answer
+            else:
+                if isinstance(audio_file, SpeculativeTurn):
+                    audio_file = audio_file.transcription
+                # The answer is dropped if the user interrupts it (see barge_in)
+                generation = self.playback_generation
+                self.current_turn = asyncio.create_task(
+                    process_audio(audio_file, self.agent,
+                                  lambda filename: self.play(filename, turn, generation),
+                                  session_id=self.session_id, output_dir=self.storage.directory, turn=turn))
+            try:
+                await asyncio.wait({self.current_turn})
+                if self.current_turn.cancelled():
+                    logger.info("Turn cancelled by the user")
+                    turn.mark("barge_in")
+                    turn.complete("playback")
+                    await self.agent.cancel_turn(self.session_id)
+                    continue
+                output_files = self.current_turn.result()
+                if not output_files:
+                    turn.complete("playback")
+            except Exception as e:
+                logger.error(f"Error processing the turn: {e}")
+                turn.complete("playback")
+            finally:
+                # Also stops the turn when the worker itself is cancelled
+                self.current_turn.cancel()
+                self.current_turn = None
+                self.turns.task_done()
 
 
     async def poll(self):
         """
-        Polling function to check audio levels and manage segments.
+        Polling function to check audio levels and detect the user turns.
         This function should be executed periodically to ensure
         timely processing of audio data.
         """
+        if self.turn_worker is None:
+            self.turn_worker = asyncio.create_task(self._turn_worker())
 
         await self.check_audio_level()
 
+
+    async def run(self):
+        """
+        Poll the call until it is disconnected, then release its resources.
+        """
+        try:
+            while self.getInfo().state != pj.PJSIP_INV_STATE_DISCONNECTED:
+                await self.poll()  # Check audio level and detect the user turns
+                await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            await self.close()
+
+
+    async def close(self):
+        """
+        Stop the turn processing and the playback worker once the call is finished.
+        """
+        self.to_reproduce.put(None)
+        if self.stt_stream:
+            self.stt_stream.cancel()
+            self.stt_stream = None
+        self.cancel_speculation()
+        if self.turn_worker:
+            self.turn_worker.cancel()
+            await asyncio.gather(self.turn_worker, return_exceptions=True)
+            self.turn_worker = None
+        self.drop_queued_turns("hangup")
+        # The conversation is rolled back before the thread is removed
+        await asyncio.gather(*self.discarded, return_exceptions=True)
+        self.discarded = []
+        self.release()
+
+    def release(self):
+        """
+        Release the shared frames and the working directory of the call (also when
+        the call could not be placed or answered).
+        """
+        if self.shared_frames:
+            self.audio_pool.release(self.shared_frames)
+            self.shared_frames = None
+        self.storage.close()
+
+class CallManager:
+    """
+    CallManager runs many MyCall instances at once, inbound and outbound.
+
+    Every call is polled by its own asyncio task and has its own working directory,
+    agent conversation thread and playback worker. The number of simultaneous calls
+    is limited by max_calls; incoming calls above the limit are rejected as busy.
+    """
+
+    def __init__(self, ep: pj.Endpoint, acc, agent, max_calls: int = MAX_CALLS):
+        self.ep = ep
+        self.acc = acc
+        self.agent = agent
+        self.max_calls = max_calls
+        self.loop = asyncio.get_running_loop()
+        self.tasks = set()
+        self.sessions = set()
+        self.active_calls = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> bool:
+        with self._lock:
+            if self.active_calls >= self.max_calls:
+                return False
+            self.active_calls += 1
+            return True
+
+    def _release(self):
+        with self._lock:
+            self.active_calls -= 1
+
+    def make_call(self, telephone):
+        """
+        Place a new outbound call.
+        """
+        if not self._reserve():
+            logger.warning(f"Call to {telephone} discarded: {self.max_calls} calls already active")
+            return None
+
+        call = None
+        try:
+            call = MyCall(self.acc, self.ep, self.agent)
+            call.makeCall(f"<sip:{telephone}@{SID_DOMAIN}>", pj.CallOpParam(True))
+        except Exception:
+            if call is not None:
+                call.release()
+            self._release()
+            raise
+        self._start(call)
+        return call
+
+    def on_incoming_call(self, call_id):
+        """
+        Answer an incoming call. This method is called from a PJSUA2 thread.
+        """
+        prm = pj.CallOpParam()
+        if not self._reserve():
+            logger.warning(f"Incoming call rejected: {self.max_calls} calls already active")
+            prm.statusCode = pj.PJSIP_SC_BUSY_HERE
+            pj.Call(self.acc, call_id).hangup(prm)
+            return
+
+        call = None
+        try:
+            call = MyCall(self.acc, self.ep, self.agent, call_id)
+            prm.statusCode = pj.PJSIP_SC_OK
+            call.answer(prm)
+        except Exception as e:
+            logger.error(f"Error answering the incoming call: {e}")
+            if call is not None:
+                call.release()
+            self._release()
+            return
+        self.loop.call_soon_threadsafe(self._start, call)
+
+    def _start(self, call):
+        self.sessions.add(call.session_id)
+        task = asyncio.create_task(self._run_call(call))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_call(self, call):
+        try:
+            await call.run()
+        finally:
+            logger.info(f"Call {call.session_id} finished")
+            await self.agent.end_thread(call.session_id)
+            self.sessions.discard(call.session_id)
+            self._release()
+            # Apply the retention policy of the recordings
+            await asyncio.to_thread(sweep, active=set(self.sessions))
+
+    async def join(self):
+        """
+        Wait until every active call is finished.
+        """
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
 # Subclass to extend the Account and get notifications etc.
 class Account(pj.Account):
+  def __init__(self):
+    pj.Account.__init__(self)
+    self.manager = None
+    # Set (in the asyncio loop) once the registration succeeds
+    self.loop = asyncio.get_running_loop()
+    self.registered = asyncio.Event()
+
   def onRegState(self, prm):
-    print("***OnRegState: " + prm.reason)
+    logger.info("***OnRegState: " + prm.reason)
     if prm.code == 200:
-       print("Registration successful!")
+       logger.info("Registration successful!")
+       self.loop.call_soon_threadsafe(self.registered.set)
     else:
-       print(f"Registration failed: {prm.code} {prm.reason}")
+       logger.warning(f"Registration failed: {prm.code} {prm.reason}")
 
+  def onIncomingCall(self, prm):
+    logger.info(f"***OnIncomingCall: {prm.callId}")
+    if self.manager and INCOMING_CALLS:
+      self.manager.on_incoming_call(prm.callId)
+    else:
+      call_prm = pj.CallOpParam()
+      call_prm.statusCode = pj.PJSIP_SC_DECLINE
+      pj.Call(self, prm.callId).hangup(call_prm)
+
+
+async def prewarm_prompts(phrases: list[str]):
+  """
+  Prewarm the TTS cache and load the synthesized phrases into the prompt cache.
+  """
+  paths = await prewarm_tts(phrases)
+  await asyncio.to_thread(get_prompt_cache().load_all, paths)
+
+
+async def create_agent():
+  """
+  Import and initialize the agent (LangChain, LangGraph and the MCP tools).
+  The heavy modules are imported in a worker thread, while the SIP stack starts.
+  """
+  agent_module = await asyncio.to_thread(importlib.import_module, "agent")
+  agent = agent_module.MCPAgent()
+  await agent._ainitialize(role=AGENT_ROLE)
+  return agent
+
+
+async def pjsua2_test(*telephones):
+  # The agent is initialized concurrently with the SIP stack and the registration
+  agent_task = asyncio.create_task(create_agent())
+
+  if METRICS_PORT:
+    metrics.serve(METRICS_PORT)
+
+  # Remove the intermediate audio left by the previous executions and apply the retention of the recordings
+  sweep(intermediate=True)
+
+  # The audio worker processes start while the SIP stack starts
+  audio_pool = get_audio_pool()
+  pool_task = asyncio.create_task(audio_pool.start()) if audio_pool else None
+
+  # Prewarm the TTS cache with the frequent phrases while the SIP stack starts
+  # Earcons and prewarmed phrases are played from memory
+  get_prompt_cache().load_all(prompt_files())
+  prewarm_task = None
+  if TTS_PREWARM_FILE:
+    prewarm_task = asyncio.create_task(prewarm_prompts(read_phrases(TTS_PREWARM_FILE)))
+  # The tasks only start on the first await: let them start their threads and processes before
+  # the SIP stack blocks the event loop
+  await asyncio.sleep(0)
 
-async def pjsua2_test(telephone):
   # Create and configure the endpoint
   ep = pj.Endpoint()
   ep.libCreate()
 
   ep_cfg = pj.EpConfig()
-  ep_cfg.logConfig.level = 5
+  ep_cfg.logConfig.level = PJSIP_LOG_LEVEL
 
   # Configure User Agent settings (uaConfig)
   ua_cfg = pj.UaConfig()
-  ua_cfg.maxCalls = 1
+  ua_cfg.maxCalls = MAX_CALLS
   # Set a public STUN server.
   proxies = pj.StringVector()
   proxies.append(STUN_PROXY)
@@ -240,6 +929,8 @@ async def pjsua2_test(telephone):
 
   # Configure Media settings
   media_cfg = pj.MediaConfig()
+  # Every port (capture, prompts and players of the converted audio) runs at the bridge clock rate
+  media_cfg.clockRate = AUDIO_CLOCK_RATE
   ep_cfg.medConfig = media_cfg
 
   ep.libInit(ep_cfg)
@@ -273,42 +964,44 @@ async def pjsua2_test(telephone):
 
   # Start the PJSUA2 library
   ep.libStart()
-  print("*** PJSUA2 STARTED ***")
+  logger.info("*** PJSUA2 STARTED ***")
 
   # Create the account
   acc = Account()
   acc.create(acc_cfg)
-  print(f"Account {acc_cfg.idUri} created.")
-
-  print("Waiting 5 secs...")
-  time.sleep(5)
-  print("continue...")
+  logger.info(f"Account {acc_cfg.idUri} created.")
 
-  # Haz la llamada
-  dest_number = f"<sip:{telephone}@{SID_DOMAIN}>"
+  logger.info("Waiting for the registration...")
+  try:
+    await asyncio.wait_for(acc.registered.wait(), REGISTRATION_TIMEOUT)
+  except asyncio.TimeoutError:
+    logger.warning(f"No registration after {REGISTRATION_TIMEOUT} secs, continuing...")
 
-  agent = MCPAgent()
-  role = "Tú eres un asistente. Utiliza las tools si piensas que te pueden dar información util, si no utiliza tu conocimiento interno. Contesta siempre en español"
-  await agent._ainitialize(role=role)
+  agent = await agent_task
+  if pool_task:
+    await pool_task
 
-  call = MyCall(acc, ep, agent)
-  call_prm = pj.CallOpParam(True)
-  
-  call.makeCall(dest_number, call_prm)
+  manager = CallManager(ep, acc, agent)
+  acc.manager = manager
 
-  # Loop while the call is active
-  while True:
-      print("Waiting the call to finish...")
-      ci = call.getInfo()
-      if ci.state == pj.PJSIP_INV_STATE_DISCONNECTED:
-          break
+  # Haz las llamadas
+  for telephone in telephones:
+    manager.make_call(telephone)
 
-      await call.poll()  # Check audio level and handle segments
-      time.sleep(0.5)
+  # Loop while the calls are active
+  logger.info("Waiting the calls to finish...")
+  if INCOMING_CALLS:
+    # Serve incoming calls until the process is stopped
+    await asyncio.Event().wait()
+  await manager.join()
 
+  await get_stt_scheduler().aclose()
+  await agent.close()
+  if audio_pool:
+    audio_pool.close()
 
   # Here we don't have anything else to do..
-  time.sleep(5)
+  await asyncio.sleep(5)
 
   # Destroy the library
   ep.libDestroy()
@@ -318,5 +1011,6 @@ async def pjsua2_test(telephone):
 #
 if __name__ == "__main__":
   args = sys.argv[1:]
-  asyncio.run(pjsua2_test(args[0]))
+  configure_logging()
+  asyncio.run(pjsua2_test(*args))
 
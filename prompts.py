@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+import wave
+from collections import OrderedDict
+
+import numpy as np
+
+from audio_codecs import read_audio
+from audio_processor import AUDIO_CLOCK_RATE
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Audio files loaded in memory at startup (comma separated), e.g. the acknowledgment tone
+PROMPT_FILES = os.getenv('PROMPT_FILES', 'Ring04.wav')
+# Maximum size of the clips kept in memory, in MB
+PROMPT_CACHE_MAX_MB = float(os.getenv('PROMPT_CACHE_MAX_MB', '32'))
+
+
+class PromptCache:
+    """
+    In-memory cache of the audio clips played frequently (earcons, prewarmed phrases),
+    decoded once into mono PCM at the playback sample rate (the call clock rate).
+
+    The clips are shared by every call and played through a memory-backed port, with no
+    file access. The total size is bounded; the least recently played clips are
+    dropped first.
+    """
+
+    def __init__(self, sample_rate: int = 16000, max_bytes: int = int(PROMPT_CACHE_MAX_MB * 1024 * 1024)):
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._clips = OrderedDict()
+        # The clips are read by the playback worker threads of the calls
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path: str) -> str:
+        return os.path.realpath(path)
+
+    def get(self, path: str):
+        """
+        PCM samples of a cached file, or None if it is not in the cache.
+        """
+        key = self.key(path)
+        with self._lock:
+            clip = self._clips.get(key)
+            if clip is not None:
+                self._clips.move_to_end(key)
+            return clip
+
+    def load(self, path: str) -> np.ndarray:
+        """
+        Decode a WAV file into the cache.
+        """
+        clip = read_audio(path, self.sample_rate)
+        key = self.key(path)
+        with self._lock:
+            if key in self._clips:
+                self.size -= self._clips[key].nbytes
+            self._clips[key] = clip
+            self.size += clip.nbytes
+            while self.size > self.max_bytes and len(self._clips) > 1:
+                _, oldest = self._clips.popitem(last=False)
+                self.size -= oldest.nbytes
+        return clip
+
+    def load_all(self, paths):
+        """
+        Load several files, skipping (and logging) the ones that cannot be read.
+        """
+        for path in paths:
+            try:
+                self.load(path)
+            except (OSError, EOFError, wave.Error, ValueError) as e:
+                logger.warning(f"Prompt {path} not loaded: {e}")
+        logger.info(f"Prompt cache: {len(self._clips)} clips, {self.size} bytes")
+
+
+_prompt_cache = None
+
+
+def get_prompt_cache() -> PromptCache:
+    """
+    Shared prompt cache, reused across turns and calls.
+    """
+    global _prompt_cache
+    if _prompt_cache is None:
+        _prompt_cache = PromptCache(AUDIO_CLOCK_RATE)
+    return _prompt_cache
+
+
+def prompt_files(files: str = PROMPT_FILES) -> list[str]:
+    return [path.strip() for path in files.split(',') if path.strip()]
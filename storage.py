@@ -0,0 +1,176 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+STORAGE_DIR = os.getenv('STORAGE_DIR', 'chat_files')
+# disk: the working directories are created in STORAGE_DIR
+# memory: they are created in a tmpfs (/dev/shm), so the intermediate audio never touches the disk
+STORAGE_MODE = os.getenv('STORAGE_MODE', 'disk').lower()
+# Keep the user utterances of every call as WAV recordings
+STORAGE_RECORDINGS = os.getenv('STORAGE_RECORDINGS', 'false').lower() in ('1', 'true', 'yes')
+# Retention of the recordings, in hours (0 keeps them until STORAGE_MAX_MB is exceeded)
+STORAGE_RETENTION_HOURS = float(os.getenv('STORAGE_RETENTION_HOURS', '72'))
+# Maximum size of the recordings, in MB. The oldest calls are removed first
+STORAGE_MAX_MB = float(os.getenv('STORAGE_MAX_MB', '500'))
+
+RECORDINGS_DIR = "recordings"
+
+
+def storage_root(mode: str = STORAGE_MODE, directory: str = STORAGE_DIR) -> str:
+    """
+    Base directory of the call working directories.
+    """
+    if mode == "memory":
+        base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        return os.path.join(base, "servantphone")
+    return directory
+
+
+def calls_root(root: str = None) -> str:
+    return os.path.join(root or storage_root(), "calls")
+
+
+class CallStorage:
+    """
+    Working directory of one call.
+
+    The intermediate audio of the call (e.g. the synthesized answers) is written in
+    this directory and removed as soon as it is consumed (see release). When the call
+    is finished, the directory is removed, except the recordings of the user
+    utterances when STORAGE_RECORDINGS is enabled; they are removed later by sweep,
+    according to the retention policy.
+    """
+
+    def __init__(self, session_id: str, root: str = None, recordings: bool = STORAGE_RECORDINGS):
+        self.session_id = session_id
+        self.directory = os.path.join(calls_root(root), session_id)
+        self.recordings = recordings
+        self._recording_index = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def owns(self, path: str) -> bool:
+        """
+        Whether the file belongs to this working directory. Shared files, like the
+        prompts or the TTS cache, are never removed.
+        """
+        directory = os.path.realpath(self.directory)
+        return os.path.commonpath([directory, os.path.realpath(path)]) == directory
+
+    def release(self, path: str):
+        """
+        The file has been consumed (e.g. played): it is removed if it belongs to the call.
+        """
+        if not self.owns(path):
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def save_recording(self, wav) -> str:
+        """
+        Store a user utterance (WAV data) when the recordings are enabled.
+        Returns the path of the recording, or None.
+        """
+        if not self.recordings:
+            return None
+        directory = self.path(RECORDINGS_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"utterance_{self._recording_index}.wav")
+        self._recording_index += 1
+        with open(path, 'wb') as wav_file:
+            wav_file.write(wav)
+        return path
+
+    def close(self):
+        """
+        Remove the working directory of the finished call, keeping only the recordings.
+        """
+        _remove_intermediate(self.directory)
+
+
+def _remove_intermediate(directory: str):
+    """
+    Remove the working directory of a call, except its recordings.
+    """
+    recordings = os.path.join(directory, RECORDINGS_DIR)
+    if not os.path.isdir(recordings):
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+
+    for entry in os.scandir(directory):
+        if entry.path == recordings:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def sweep(root: str = None, active: set = (), retention_hours: float = STORAGE_RETENTION_HOURS,
+          max_mb: float = STORAGE_MAX_MB, intermediate: bool = False):
+    """
+    Apply the retention policy to the directories of the finished calls: the calls
+    older than retention_hours are removed, then the oldest ones until the total size
+    is below max_mb. The directories of the active calls (session ids) are skipped.
+
+    With intermediate, the audio left by an interrupted execution (e.g. the synthesized
+    answers) is removed first, keeping only the recordings. This is only done at startup,
+    before any call is started: a call being set up may not be in `active` yet.
+    """
+    directory = calls_root(root)
+    if not os.path.isdir(directory):
+        return
+
+    calls = []
+    for entry in os.scandir(directory):
+        if not entry.is_dir(follow_symlinks=False) or entry.name in active:
+            continue
+        mtime = entry.stat().st_mtime
+        if intermediate:
+            _remove_intermediate(entry.path)
+            if not os.path.isdir(entry.path):
+                continue
+            # The retention of the recordings still counts from the end of the call
+            os.utime(entry.path, (mtime, mtime))
+        calls.append((mtime, entry.path, _directory_size(entry.path)))
+    calls.sort()
+
+    now = time.time()
+    total = sum(size for _, _, size in calls)
+    removed = 0
+    for mtime, path, size in calls:
+        expired = retention_hours > 0 and now - mtime > retention_hours * 3600
+        if not expired and total <= max_mb * 1024 * 1024:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+
+    if removed:
+        logger.info(f"Storage sweep: {removed} calls removed, {total} bytes kept")
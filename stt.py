@@ -0,0 +1,473 @@
+import asyncio
+import itertools
+import logging
+import json
+import os
+import struct
+import time
+
+import httpx
+import numpy as np
+
+from audio_codecs import CONTENT_TYPES, StreamEncoder, encode, negotiate, read_wav, wav_data
+from audio_workers import get_audio_pool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+STT_APIKEY = os.getenv('STT_APIKEY')
+STT_URL = os.getenv('STT_URL')
+# Streaming mode: the utterance is uploaded while the user is still speaking
+STT_STREAMING = os.getenv('STT_STREAMING', 'false').lower() in ('1', 'true', 'yes')
+# Audio codecs accepted by the STT service, in order of preference (wav, flac, opus).
+# The first one that can be encoded is used; WAV is the fallback
+STT_CODECS = os.getenv('STT_CODECS', 'wav')
+# STT engine: http (STT_URL service), local (in-process faster-whisper model) or fake
+STT_BACKEND = os.getenv('STT_BACKEND', 'http').lower()
+# Maximum number of transcriptions (or batches) in progress at the same time, for every call
+STT_MAX_CONCURRENCY = int(os.getenv('STT_MAX_CONCURRENCY', '4'))
+# Maximum number of utterances per batch, when the backend supports batches
+STT_BATCH_SIZE = int(os.getenv('STT_BATCH_SIZE', '8'))
+# Time to wait for more utterances before sending an incomplete batch. 0 only batches the queued utterances
+STT_BATCH_WAIT_MS = float(os.getenv('STT_BATCH_WAIT_MS', '0'))
+STT_LOCAL_MODEL = os.getenv('STT_LOCAL_MODEL', 'small')
+STT_LANGUAGE = os.getenv('STT_LANGUAGE', 'es')
+STT_FAKE_TEXT = os.getenv('STT_FAKE_TEXT', 'Hola, ¿qué tiempo hace hoy?')
+
+
+def parse_transcripts(decoder: json.JSONDecoder, buffer: str):
+    """
+    Parse every complete JSON object available in the buffer.
+    The STT service answers with a sequence of JSON objects, the last one being the
+    final transcription.
+
+    Returns the parsed objects and the remaining (incomplete) text.
+    """
+    results = []
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position >= len(buffer):
+            break
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            break
+        results.append(item)
+
+    return results, buffer[position:]
+
+
+def read_pcm(audio) -> np.ndarray:
+    """
+    16-bit PCM samples of a WAV file path or in-memory WAV data.
+    """
+    return read_wav(audio)[0]
+
+
+def audio_duration(audio, sample_rate: int = 16000) -> float:
+    """
+    Approximate duration in seconds of a 16-bit mono WAV (file path or in-memory data),
+    from its size.
+    """
+    size = os.path.getsize(audio) if isinstance(audio, str) else memoryview(audio).nbytes
+    return max(size - 44, 0) / (2 * sample_rate)
+
+
+class STTBackend:
+    """
+    Speech-to-text engine.
+
+    Backends implement transcribe (one utterance). Backends able to transcribe several
+    utterances at once declare max_batch_size > 1 and implement transcribe_batch.
+    """
+
+    streaming = False
+    max_batch_size = 1
+    # Audio codecs accepted by the backend, in order of preference (see audio_codecs)
+    codecs = ("wav",)
+
+    async def transcribe(self, audio) -> str:
+        raise NotImplementedError
+
+    async def transcribe_batch(self, audios: list) -> list[str]:
+        return list(await asyncio.gather(*[self.transcribe(audio) for audio in audios]))
+
+    def open_stream(self, sample_rate: int = 16000) -> 'STTStream':
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+
+    async def aclose(self):
+        pass
+
+
+class STTStream:
+    """
+    Streaming transcription of one utterance.
+
+    The upload is opened as soon as the speech starts, with a chunked request body
+    (WAV header with unknown size followed by the PCM data, or the compressed stream
+    when the client negotiated a codec). The audio is pushed while it is captured and
+    the STT results are read incrementally, so the transcription is ready almost as
+    soon as the user stops speaking.
+    """
+
+    def __init__(self, client: 'STTClient', sample_rate: int = 16000):
+        self.client = client
+        self.sample_rate = sample_rate
+        self.codec = client.codec
+        self.text = None
+        self._encoder = None
+        if self.codec != "wav":
+            try:
+                self._encoder = StreamEncoder(self.codec, sample_rate)
+            except Exception as e:
+                logger.warning(f"Error opening the {self.codec} encoder, sending WAV: {e}")
+                self.codec = "wav"
+        # PCM copy of the compressed utterances, to send it again as WAV if the codec is rejected
+        self._pcm = bytearray()
+        self._chunks = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def push(self, pcm: bytes):
+        """
+        Send a new piece of 16-bit mono PCM audio.
+        """
+        self._chunks.put_nowait(pcm)
+
+    async def finish(self) -> str:
+        """
+        Close the upload and wait for the final transcription.
+        """
+        self._chunks.put_nowait(None)
+        return await self._task
+
+    def cancel(self):
+        self._task.cancel()
+
+    def _wav_header(self) -> bytes:
+        # Streamed WAV: the data size is unknown, so the maximum value is used
+        return struct.pack('<4sI4s4sIHHIIHH4sI',
+                           b'RIFF', 0xFFFFFFFF, b'WAVE',
+                           b'fmt ', 16, 1, 1, self.sample_rate, self.sample_rate * 2, 2, 16,
+                           b'data', 0xFFFFFFFF)
+
+    async def _body(self):
+        if self._encoder is None:
+            yield self._wav_header()
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                break
+            if self._encoder is None:
+                yield chunk
+                continue
+            self._pcm += chunk
+            data = self._encoder.encode(chunk)
+            if data:
+                yield data
+        if self._encoder is not None:
+            yield self._encoder.finish()
+
+    async def _run(self) -> str:
+        decoder = json.JSONDecoder()
+        pending = ""
+        async with self.client.http.stream("POST", self.client.url,
+                                           headers=self.client.headers(self.codec),
+                                           content=self._body()) as response:
+            rejected = self.client.rejected(response, self.codec)
+            if not rejected:
+                response.raise_for_status()
+                async for text in response.aiter_text():
+                    results, pending = parse_transcripts(decoder, pending + text)
+                    for result in results:
+                        self.text = result.get('text', self.text)
+                        logger.debug(f"STT partial result: '{self.text}'")
+
+        if rejected:
+            # The whole request body has been sent: the utterance is complete
+            return await self.client.transcribe(wav_data(bytes(self._pcm), self.sample_rate))
+        if self.text is None:
+            raise ValueError("No transcription received from the STT service")
+        return self.text
+
+
+class STTClient(STTBackend):
+    """
+    Asynchronous client of the STT service (http backend).
+
+    A single pooled HTTP session (keep-alive connections) is shared by every turn.
+    The service transcribes one utterance per request; it also supports streaming.
+
+    The utterances are compressed with the first codec of STT_CODECS that can be
+    encoded. If the service rejects the compressed audio, the utterance is sent again
+    as WAV and the client keeps using WAV.
+    """
+
+    streaming = True
+
+    def __init__(self, url: str = STT_URL, api_key: str = STT_APIKEY, max_connections: int = 10,
+                 codecs: str = STT_CODECS):
+        self.url = url
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.codecs = tuple(codec.strip().lower() for codec in codecs.split(',') if codec.strip())
+        self.codec = negotiate(self.codecs)
+        logger.info(f"STT audio codec: {self.codec}")
+        self._http = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections,
+                                    keepalive_expiry=60.0),
+                timeout=httpx.Timeout(30.0, read=None))
+        return self._http
+
+    def headers(self, codec: str = "wav") -> dict:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": CONTENT_TYPES[codec]
+        }
+
+    def rejected(self, response: httpx.Response, codec: str) -> bool:
+        """
+        Whether the service rejected the compressed audio. The client falls back to WAV.
+        """
+        if codec == "wav" or response.status_code not in (400, 415):
+            return False
+        logger.warning(f"The STT service rejected the {codec} audio ({response.status_code}), falling back to WAV")
+        self.codec = "wav"
+        return True
+
+    def open_stream(self, sample_rate: int = 16000) -> STTStream:
+        """
+        Start the streaming transcription of a new utterance.
+        """
+        return STTStream(self, sample_rate)
+
+    async def _post(self, audio, codec: str) -> httpx.Response:
+        headers = self.headers(codec)
+        if isinstance(audio, str):
+            with open(audio, 'rb') as audio_file:
+                content = audio_file.read()
+        elif isinstance(audio, bytes):
+            content = audio
+        else:
+            # Send the memoryview as it is (see UtteranceBuffer), without copying it
+            audio = memoryview(audio).cast('B')
+            headers["Content-Length"] = str(audio.nbytes)
+
+            async def content_stream():
+                yield audio
+
+            content = content_stream()
+
+        return await self.http.post(self.url, headers=headers, content=content)
+
+    async def transcribe(self, audio) -> str:
+        """
+        Transcribe a complete utterance: a WAV file path or in-memory WAV data.
+        """
+        codec = self.codec
+        content = audio
+        if codec != "wav":
+            # Opus encoding takes tens of milliseconds per second of audio
+            pool = get_audio_pool()
+            if pool and not isinstance(audio, str):
+                content, codec = await pool.encode(audio, codec)
+            else:
+                content, codec = await asyncio.to_thread(encode, audio, codec)
+
+        response = await self._post(content, codec)
+        if self.rejected(response, codec):
+            response = await self._post(audio, "wav")
+        response.raise_for_status()  # Lanza una excepción HTTPError para respuestas 4xx/5xx
+
+        results, _ = parse_transcripts(json.JSONDecoder(), response.text)
+        if not results:
+            raise ValueError(f"Unexpected response from the STT service: {response.text}")
+        return results[-1]['text']
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class LocalSTTBackend(STTBackend):
+    """
+    In-process speech-to-text engine, based on faster-whisper (optional dependency).
+
+    The model is loaded on first use. Every batch is transcribed in a worker thread,
+    so the event loop is not blocked.
+    """
+
+    max_batch_size = STT_BATCH_SIZE
+
+    def __init__(self, model: str = STT_LOCAL_MODEL, language: str = STT_LANGUAGE,
+                 num_workers: int = STT_MAX_CONCURRENCY):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError("STT_BACKEND=local requires faster-whisper (pip install faster-whisper)") from e
+        self._model_class = WhisperModel
+        self.model_name = model
+        self.language = language
+        self.num_workers = num_workers
+        self._model = None
+
+    def _transcribe_sync(self, audios: list) -> list[str]:
+        if self._model is None:
+            logger.info(f"Loading the local STT model {self.model_name}")
+            self._model = self._model_class(self.model_name, num_workers=self.num_workers)
+
+        texts = []
+        for audio in audios:
+            samples = read_pcm(audio).astype(np.float32) / 32768.0
+            segments, _ = self._model.transcribe(samples, language=self.language, beam_size=1)
+            texts.append(" ".join(segment.text.strip() for segment in segments))
+        return texts
+
+    async def transcribe_batch(self, audios: list) -> list[str]:
+        return await asyncio.to_thread(self._transcribe_sync, audios)
+
+    async def transcribe(self, audio) -> str:
+        return (await self.transcribe_batch([audio]))[0]
+
+
+class FakeSTTBackend(STTBackend):
+    """
+    Fake engine for tests and benchmarks: every utterance is transcribed as the same
+    text after a fixed latency per batch.
+    """
+
+    def __init__(self, text: str = STT_FAKE_TEXT, latency: float = 0.0, max_batch_size: int = STT_BATCH_SIZE):
+        self.text = text
+        self.latency = latency
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+
+    async def transcribe_batch(self, audios: list) -> list[str]:
+        self.batches += 1
+        await asyncio.sleep(self.latency)
+        return [self.text] * len(audios)
+
+    async def transcribe(self, audio) -> str:
+        return (await self.transcribe_batch([audio]))[0]
+
+
+class STTScheduler:
+    """
+    Shared queue of the utterances to transcribe, from every call.
+
+    A fixed number of workers (max_concurrency) take the utterances from the queue, so
+    the load on the STT backend is bounded whatever the number of calls. When the
+    backend supports batches, every worker takes as many queued utterances as the
+    batch allows (waiting batch_wait seconds for more, if configured).
+
+    Short utterances are transcribed first: the queue is ordered by arrival time plus
+    the duration of the utterance, so a short utterance overtakes the longer ones
+    queued shortly before it, while a long utterance is never postponed indefinitely.
+    """
+
+    def __init__(self, backend: STTBackend = None, max_concurrency: int = STT_MAX_CONCURRENCY,
+                 batch_wait: float = STT_BATCH_WAIT_MS / 1000):
+        self.backend = backend or get_stt_backend()
+        self.max_concurrency = max_concurrency
+        self.batch_wait = batch_wait
+        self._queue = None
+        self._workers = []
+        self._sequence = itertools.count()
+
+    def _start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def transcribe(self, audio) -> str:
+        """
+        Queue an utterance (WAV file path or in-memory WAV data) and wait for its transcription.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        priority = time.monotonic() + audio_duration(audio)
+        self._queue.put_nowait((priority, next(self._sequence), audio, future))
+        logger.debug(f"STT queue: {self._queue.qsize()} utterances")
+        return await future
+
+    async def _next(self):
+        # The utterances of the cancelled turns are skipped
+        while True:
+            item = await self._queue.get()
+            if not item[3].done():
+                return item
+
+    async def _worker(self):
+        while True:
+            batch = [await self._next()]
+            if self.backend.max_batch_size > 1:
+                if self.batch_wait and self._queue.empty():
+                    await asyncio.sleep(self.batch_wait)
+                while len(batch) < self.backend.max_batch_size and not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if not item[3].done():
+                        batch.append(item)
+
+            try:
+                texts = await self.backend.transcribe_batch([item[2] for item in batch])
+            except Exception as e:
+                for item in batch:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+                continue
+
+            for item, text in zip(batch, texts):
+                if not item[3].done():
+                    item[3].set_result(text)
+
+    async def aclose(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self.backend.aclose()
+
+
+_stt_backend = None
+_stt_scheduler = None
+
+
+def get_stt_backend() -> STTBackend:
+    """
+    Shared STT backend (see STT_BACKEND), reused across turns and calls.
+    """
+    global _stt_backend
+    if _stt_backend is None:
+        if STT_BACKEND == "local":
+            _stt_backend = LocalSTTBackend()
+        elif STT_BACKEND == "fake":
+            _stt_backend = FakeSTTBackend()
+        elif STT_BACKEND == "http":
+            _stt_backend = STTClient()
+        else:
+            raise ValueError(f"Unknown STT_BACKEND: {STT_BACKEND}")
+    return _stt_backend
+
+
+def get_stt_scheduler() -> STTScheduler:
+    """
+    Shared STT scheduler, queuing the utterances of every call.
+    """
+    global _stt_scheduler
+    if _stt_scheduler is None:
+        _stt_scheduler = STTScheduler()
+    return _stt_scheduler
@@ -0,0 +1,75 @@
+import re
+
+# A sentence ends with a punctuation mark followed by a blank, or with a line break
+SENTENCE_END = re.compile(r'(?<=[.!?…:;])\s+|\n+')
+
+# Sentences shorter than this are joined with the next one, to avoid tiny TTS requests
+MIN_SENTENCE_LENGTH = 20
+
+
+def split_sentences(text: str, min_length: int = MIN_SENTENCE_LENGTH) -> list[str]:
+    """
+    Split a text into sentences to be synthesized independently.
+    Very short sentences (e.g. "Sí.") are merged with the following one.
+    """
+    sentences = []
+    pending = ""
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        pending = f"{pending} {sentence}" if pending else sentence
+        if len(pending) >= min_length:
+            sentences.append(pending)
+            pending = ""
+
+    if pending:
+        if sentences and len(pending) < min_length:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+
+    return sentences
+
+
+class SentenceBuffer:
+    """
+    Incremental sentence splitter for streamed text (e.g. LLM tokens).
+
+    The text is fed piece by piece and every complete sentence is returned as soon
+    as it is formed. The rest is kept until more text arrives or the stream ends.
+    """
+
+    def __init__(self, min_length: int = MIN_SENTENCE_LENGTH):
+        self.min_length = min_length
+        self._text = ""
+        self._pending = ""
+
+    def feed(self, text: str) -> list[str]:
+        """
+        Add a new piece of text and return the sentences completed by it.
+        """
+        self._text += text
+        parts = SENTENCE_END.split(self._text)
+        # The last part can be an incomplete sentence
+        self._text = parts.pop()
+
+        sentences = []
+        for sentence in parts:
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            self._pending = f"{self._pending} {sentence}" if self._pending else sentence
+            if len(self._pending) >= self.min_length:
+                sentences.append(self._pending)
+                self._pending = ""
+        return sentences
+
+    def flush(self) -> list[str]:
+        """
+        End of the stream: return the remaining text as the last sentence.
+        """
+        last = " ".join(part for part in (self._pending, self._text.strip()) if part)
+        self._text = ""
+        self._pending = ""
+        return [last] if last else []
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'chat_files/tts_cache')
+# Maximum size of the cache in MB. 0 disables the cache
+TTS_CACHE_MAX_MB = float(os.getenv('TTS_CACHE_MAX_MB', '200'))
+# Optional text file with one phrase per line, synthesized at startup
+TTS_PREWARM_FILE = os.getenv('TTS_PREWARM_FILE')
+
+
+class TTSCache:
+    """
+    Content-addressed disk cache of synthesized speech.
+
+    Each audio file is stored under the hash of everything that determines its content
+    (text, model, voice, speed, format and sample rate). The total size of the cache is bounded;
+    when it is exceeded, the least recently used files are removed. The LRU order is
+    kept in memory and persisted through the modification time of the files, so it
+    survives restarts.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MAX_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+        Rebuild the index from the files already in the cache directory, oldest first.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+
+        self._evict()
+        logger.info(f"TTS cache loaded: {len(self._entries)} files, {self.size} bytes")
+
+    @staticmethod
+    def key(text: str, model: str, voice: str, speed: float, response_format: str, sample_rate: int = None) -> str:
+        """
+        Name of the cache file for the given synthesis parameters (and the sample rate
+        of the stored audio, when it is converted).
+        """
+        params = [text, model, voice, speed, response_format]
+        if sample_rate:
+            params.append(sample_rate)
+        params = json.dumps(params, ensure_ascii=False)
+        return f"{hashlib.sha256(params.encode('utf-8')).hexdigest()}.{response_format}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str):
+        """
+        Path of the cached file, or None if it is not in the cache.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._remove(key)
+            return None
+        return path
+
+    def add(self, key: str, temp_path: str) -> str:
+        """
+        Move a new synthesized file into the cache. Returns its final path.
+        """
+        path = self.path(key)
+        os.replace(temp_path, path)
+        if key in self._entries:
+            self.size -= self._entries[key]
+        self._entries[key] = os.path.getsize(path)
+        self._entries.move_to_end(key)
+        self.size += self._entries[key]
+        self._evict(keep=key)
+        return path
+
+    async def get_or_create(self, key: str, create) -> str:
+        """
+        Return the cached file or create it with `create(temp_path)`.
+        Concurrent requests of the same key share a single synthesis.
+        """
+        path = self.get(key)
+        if path:
+            return path
+
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(self._create(key, create))
+        return await asyncio.shield(self._pending[key])
+
+    async def _create(self, key: str, create) -> str:
+        temp_path = self.path(key) + ".tmp"
+        try:
+            await create(temp_path)
+            return self.add(key, temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            del self._pending[key]
+
+    def _remove(self, key: str):
+        self.size -= self._entries.pop(key)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: str = None):
+        while self.size > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            self._remove(oldest)
+
+
+def read_phrases(file_path: str) -> list[str]:
+    """
+    Read the list of phrases to prewarm the cache: one phrase per line, empty lines
+    and lines starting with # are ignored.
+    """
+    with open(file_path, encoding='utf-8') as phrases_file:
+        return [line.strip() for line in phrases_file if line.strip() and not line.startswith('#')]